@@ -0,0 +1,112 @@
+"""Нагрузочный прогон бота на заглушках Marzban, ЮKassa и Telegram Bot API.
+
+Запуск из каталога finik_vpn_bot:
+
+    python -m bench --scenarios webhook,payments,sweep,broadcast --sweep-users 50000
+
+Postgres поднимается во временном каталоге (нужны initdb и pg_ctl) или создаётся
+отдельная база на сервере из --database-url / BENCH_DATABASE_URL; после прогона удаляется.
+"""
+from bench.fakes import FakeMarzban, FakeYooKassa, FakeTelegram
+from bench.postgres import ThrowawayPostgres
+from bench.report import print_results
+import argparse
+import asyncio
+import os
+
+SCENARIOS = ("webhook", "payments", "sweep", "broadcast")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Сценарии через запятую: {', '.join(SCENARIOS)}")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"),
+                        help="URL уже запущенного Postgres (база postgres); иначе свой кластер через initdb")
+    parser.add_argument("--concurrency", type=int, default=100, help="Параллельных запросов к вебхукам")
+    parser.add_argument("--updates", type=int, default=5000, help="Апдейтов в пачке /telegram_webhook")
+    parser.add_argument("--update-users", type=int, default=2000, help="Разных пользователей в пачке апдейтов")
+    parser.add_argument("--webhook-workers", type=int, default=16)
+    parser.add_argument("--webhook-queue-size", type=int, default=1000)
+    parser.add_argument("--payments", type=int, default=2000, help="Оплат в шторме /yookassa_webhook")
+    parser.add_argument("--duplicate-rate", type=float, default=0.1, help="Доля повторно доставленных вебхуков")
+    parser.add_argument("--sweep-users", type=int, default=10000, help="Синтетических пользователей для прохода")
+    parser.add_argument("--sweep-mode", choices=("due", "per_user", "reconcile"), default="due")
+    parser.add_argument("--sweep-concurrency", type=int, default=50)
+    parser.add_argument("--broadcast-users", type=int, default=2000)
+    parser.add_argument("--broadcast-rate", type=float, default=500, help="Сообщений в секунду для рассылки")
+    for service, latency in (("marzban", 0.02), ("yookassa", 0.05), ("telegram", 0.03)):
+        parser.add_argument(f"--{service}-latency", type=float, default=latency, help="Средняя задержка, с")
+        parser.add_argument(f"--{service}-errors", type=float, default=0.0, help="Доля ответов с ошибкой")
+    parser.add_argument("--telegram-blocked", type=float, default=0.01, help="Доля пользователей, заблокировавших бота")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", help="Сохранить результаты в JSON-файл")
+    return parser.parse_args()
+
+
+def configure_environment(args, marzban, yookassa, telegram, database_url):
+    # Всё, что config читает при импорте, выставляется до импорта модулей бота
+    os.environ.update({
+        "TELEGRAM_BOT_TOKEN": "123456789:BENCH-token",
+        "TELEGRAM_API_URL": telegram.url,
+        "DATABASE_URL": database_url,
+        "MARZBAN_URL": marzban.url,
+        "ADMIN_USERNAME": "bench",
+        "ADMIN_PASSWORD": "bench",
+        "YUKASSA_SHOP_ID": "bench",
+        "YUKASSA_SECRET_KEY": "bench",
+        "YUKASSA_API_URL": yookassa.url,
+        "ADMIN_ID": "1",
+        "WEB_PROCESSES": "1",
+        "WEBHOOK_MODE": "queue",
+        "SWEEP_CONCURRENCY": str(args.sweep_concurrency),
+        "BROADCAST_RATE": str(args.broadcast_rate),
+        "LOG_LEVEL": args.log_level,
+    })
+
+
+async def run(args):
+    selected = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(selected) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    marzban = FakeMarzban(args.marzban_latency, args.marzban_errors)
+    yookassa = FakeYooKassa(args.yookassa_latency, args.yookassa_errors)
+    telegram = FakeTelegram(args.telegram_latency, args.telegram_errors, blocked_rate=args.telegram_blocked)
+    postgres = ThrowawayPostgres(args.database_url)
+    for fake in (marzban, yookassa, telegram):
+        await fake.start()
+    database_url = await postgres.start()
+    configure_environment(args, marzban, yookassa, telegram, database_url)
+
+    from bench import scenarios
+
+    app = scenarios.BenchApp(marzban)
+    results = []
+    try:
+        await app.start()
+        if "webhook" in selected:
+            results.append(await scenarios.webhook_burst(
+                app, args.updates, args.concurrency, args.update_users,
+                args.webhook_workers, args.webhook_queue_size
+            ))
+        if "payments" in selected:
+            results.append(await scenarios.payment_storm(app, args.payments, args.concurrency, args.duplicate_rate))
+        if "sweep" in selected:
+            results.append(await scenarios.subscription_sweep(app, args.sweep_users, args.sweep_mode))
+        if "broadcast" in selected:
+            results.append(await scenarios.broadcast_run(app, args.broadcast_users))
+    finally:
+        await app.stop()
+        await postgres.stop()
+        for fake in (marzban, yookassa, telegram):
+            await fake.stop()
+        from utils.log import stop_logging
+        stop_logging()
+
+    print_results(results, args.json)
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,232 @@
+from abc import ABC, abstractmethod
+from aiohttp import web
+from datetime import datetime
+import asyncio
+import base64
+import json
+import random
+import time
+import uuid
+
+
+class FakeService(ABC):
+    # Заглушка внешнего API на aiohttp: задержка каждого ответа и доля ошибок настраиваются
+    name = "fake"
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self.calls = {}
+        self.url = None
+        self._runner = None
+
+    @web.middleware
+    async def _chaos(self, request, handler):
+        self.requests += 1
+        if self.latency:
+            # Разброс ±50% вокруг средней задержки
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return self.error_response(request)
+        return await handler(request)
+
+    def error_response(self, request):
+        return web.json_response({"detail": "injected error"}, status=500)
+
+    @abstractmethod
+    def routes(self):
+        ...
+
+    def count(self, call):
+        self.calls[call] = self.calls.get(call, 0) + 1
+
+    async def start(self):
+        app = web.Application(middlewares=[self._chaos])
+        app.add_routes(self.routes())
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        # Порт 0 — свободный порт выбирает ОС; узнаём его из адресов, которые слушает runner
+        port = self._runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def _jwt(exp):
+    def part(data):
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b"=").decode()
+    return f"{part({'alg': 'HS256', 'typ': 'JWT'})}.{part({'sub': 'bench', 'exp': exp})}.c2ln"
+
+
+class FakeMarzban(FakeService):
+    name = "marzban"
+
+    def __init__(self, latency=0.0, error_rate=0.0, token_ttl=86400):
+        super().__init__(latency, error_rate)
+        self.token_ttl = token_ttl
+        self.users = {}
+        self.tokens = set()
+
+    def add_user(self, username, status="active", online_at=None):
+        self.users[username] = {
+            "username": username,
+            "status": status,
+            "subscription_url": f"https://vpn.bench/sub/{username}/{uuid.uuid4().hex[:8]}",
+            "online_at": online_at,
+            "created_at": datetime.utcnow().isoformat(),
+        }
+
+    def routes(self):
+        return [
+            web.post("/api/admin/token", self.token),
+            web.get("/api/inbounds", self.inbounds),
+            web.get("/api/users", self.list_users),
+            web.post("/api/user", self.create_user),
+            web.get("/api/user/{username}", self.get_user),
+            web.put("/api/user/{username}", self.modify_user),
+            web.delete("/api/user/{username}", self.delete_user),
+        ]
+
+    def _authorized(self, request):
+        header = request.headers.get("Authorization", "")
+        return header.startswith("Bearer ") and header[7:] in self.tokens
+
+    async def token(self, request):
+        self.count("token")
+        token = _jwt(int(time.time()) + self.token_ttl)
+        self.tokens.add(token)
+        return web.json_response({"access_token": token, "token_type": "bearer"})
+
+    async def inbounds(self, request):
+        self.count("inbounds")
+        if not self._authorized(request):
+            return web.json_response({"detail": "unauthorized"}, status=401)
+        return web.json_response({"vless": [
+            {"tag": "VLESS TCP REALITY", "protocol": "vless", "network": "tcp", "tls": "reality", "port": 443}
+        ]})
+
+    async def list_users(self, request):
+        self.count("list_users")
+        if not self._authorized(request):
+            return web.json_response({"detail": "unauthorized"}, status=401)
+        offset = int(request.query.get("offset", 0))
+        limit = int(request.query.get("limit", 100))
+        users = list(self.users.values())
+        return web.json_response({"users": users[offset:offset + limit], "total": len(users)})
+
+    async def create_user(self, request):
+        self.count("create_user")
+        if not self._authorized(request):
+            return web.json_response({"detail": "unauthorized"}, status=401)
+        username = (await request.json())["username"]
+        if username in self.users:
+            return web.json_response({"detail": "User already exists"}, status=409)
+        self.add_user(username)
+        return web.json_response(self.users[username])
+
+    async def get_user(self, request):
+        self.count("get_user")
+        if not self._authorized(request):
+            return web.json_response({"detail": "unauthorized"}, status=401)
+        user = self.users.get(request.match_info["username"])
+        if user is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        return web.json_response(user)
+
+    async def modify_user(self, request):
+        self.count("modify_user")
+        if not self._authorized(request):
+            return web.json_response({"detail": "unauthorized"}, status=401)
+        user = self.users.get(request.match_info["username"])
+        if user is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        user.update(await request.json())
+        return web.json_response(user)
+
+    async def delete_user(self, request):
+        self.count("delete_user")
+        if not self._authorized(request):
+            return web.json_response({"detail": "unauthorized"}, status=401)
+        if self.users.pop(request.match_info["username"], None) is None:
+            return web.json_response({"detail": "User not found"}, status=404)
+        return web.json_response({"detail": "User successfully deleted"})
+
+
+class FakeYooKassa(FakeService):
+    name = "yookassa"
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        super().__init__(latency, error_rate)
+        self.payments = {}
+
+    def routes(self):
+        return [web.post("/payments", self.create_payment)]
+
+    async def create_payment(self, request):
+        self.count("create_payment")
+        key = request.headers.get("Idempotence-Key")
+        if key in self.payments:
+            return web.json_response(self.payments[key])
+        body = await request.json()
+        payment_id = str(uuid.uuid4())
+        payment = {
+            "id": payment_id,
+            "status": "pending",
+            "amount": body.get("amount"),
+            "metadata": body.get("metadata", {}),
+            "confirmation": {
+                "type": "redirect",
+                "confirmation_url": f"https://yoomoney.bench/checkout/{payment_id}"
+            },
+        }
+        self.payments[key] = payment
+        return web.json_response(payment)
+
+
+class FakeTelegram(FakeService):
+    # Отвечает на любой метод Bot API; доля ошибок отдаётся как 429 с retry_after
+    name = "telegram"
+
+    def __init__(self, latency=0.0, error_rate=0.0, retry_after=1, blocked_rate=0.0):
+        super().__init__(latency, error_rate)
+        self.retry_after = retry_after
+        self.blocked_rate = blocked_rate
+        self._message_id = 0
+
+    def routes(self):
+        return [web.post("/bot{token}/{method}", self.call)]
+
+    def error_response(self, request):
+        return web.json_response({
+            "ok": False, "error_code": 429,
+            "description": f"Too Many Requests: retry after {self.retry_after}",
+            "parameters": {"retry_after": self.retry_after}
+        }, status=429)
+
+    async def call(self, request):
+        method = request.match_info["method"]
+        self.count(method)
+        form = await request.post()
+        if method.startswith("send"):
+            if self.blocked_rate and random.random() < self.blocked_rate:
+                return web.json_response({
+                    "ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"
+                }, status=403)
+            self._message_id += 1
+            chat_id = int(form.get("chat_id", 0))
+            return web.json_response({"ok": True, "result": {
+                "message_id": self._message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": form.get("text", ""),
+            }})
+        return web.json_response({"ok": True, "result": True})
@@ -0,0 +1,77 @@
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import uuid
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _pg_bin(name):
+    # Ищем бинарники PostgreSQL в PATH, затем в каталоге из pg_config
+    path = shutil.which(name)
+    if path:
+        return path
+    pg_config = shutil.which("pg_config")
+    if pg_config:
+        bindir = subprocess.run([pg_config, "--bindir"], capture_output=True, text=True).stdout.strip()
+        candidate = os.path.join(bindir, name)
+        if os.path.exists(candidate):
+            return candidate
+    raise RuntimeError(f"{name} не найден: установите PostgreSQL или задайте BENCH_DATABASE_URL")
+
+
+class ThrowawayPostgres:
+    # Одноразовая база для прогона: либо свой кластер во временном каталоге (initdb + pg_ctl),
+    # либо отдельная база в уже запущенном сервере из BENCH_DATABASE_URL. После прогона удаляется
+    def __init__(self, admin_url=None):
+        self._admin_url = admin_url
+        self._data_dir = None
+        self._database = f"bench_{uuid.uuid4().hex[:8]}"
+        self.url = None
+
+    async def start(self):
+        if self._admin_url is None:
+            self._data_dir = tempfile.mkdtemp(prefix="finik_bench_pg_")
+            port = _free_port()
+            subprocess.run(
+                [_pg_bin("initdb"), "-D", self._data_dir, "-U", "bench", "--auth=trust", "-E", "UTF8"],
+                check=True, capture_output=True
+            )
+            subprocess.run(
+                [_pg_bin("pg_ctl"), "-D", self._data_dir, "-w", "-l", os.path.join(self._data_dir, "server.log"),
+                 "-o", f"-p {port} -k {self._data_dir} -c listen_addresses=127.0.0.1 "
+                       f"-c fsync=off -c synchronous_commit=off -c max_connections=200",
+                 "start"],
+                check=True, capture_output=True
+            )
+            self._admin_url = f"postgresql://bench@127.0.0.1:{port}/postgres"
+        await self._execute(f'CREATE DATABASE "{self._database}"')
+        self.url = self._admin_url.rsplit("/", 1)[0] + f"/{self._database}"
+        return self.url
+
+    async def _execute(self, sql):
+        import asyncpg
+        conn = await asyncpg.connect(self._admin_url)
+        try:
+            await conn.execute(sql)
+        finally:
+            await conn.close()
+
+    async def stop(self):
+        if self.url is not None:
+            await self._execute(f'DROP DATABASE IF EXISTS "{self._database}" WITH (FORCE)')
+            self.url = None
+        if self._data_dir is not None:
+            await asyncio.to_thread(
+                subprocess.run, [_pg_bin("pg_ctl"), "-D", self._data_dir, "-m", "fast", "stop"],
+                capture_output=True
+            )
+            shutil.rmtree(self._data_dir, ignore_errors=True)
+            self._data_dir = None
@@ -0,0 +1,53 @@
+from dataclasses import dataclass, field
+import json
+import time
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+@dataclass
+class Result:
+    scenario: str
+    count: int = 0
+    errors: int = 0
+    latencies: list = field(default_factory=list)
+    started_at: float = field(default_factory=time.perf_counter)
+    duration: float = 0.0
+    extra: dict = field(default_factory=dict)
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started_at
+        return self
+
+    def as_dict(self):
+        return {
+            "scenario": self.scenario,
+            "count": self.count,
+            "errors": self.errors,
+            "duration_s": round(self.duration, 3),
+            "throughput_per_s": round(self.count / self.duration, 1) if self.duration else 0.0,
+            "p50_ms": round(percentile(self.latencies, 0.5) * 1000, 2),
+            "p99_ms": round(percentile(self.latencies, 0.99) * 1000, 2),
+            "max_ms": round(max(self.latencies, default=0.0) * 1000, 2),
+            **self.extra,
+        }
+
+
+def print_results(results, json_path=None):
+    rows = [result.as_dict() for result in results]
+    columns = ("scenario", "count", "errors", "duration_s", "throughput_per_s", "p50_ms", "p99_ms", "max_ms")
+    widths = {c: max(len(c), *(len(str(row[c])) for row in rows)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    for row in rows:
+        print("  ".join(str(row[c]).ljust(widths[c]) for c in columns))
+        extra = {k: v for k, v in row.items() if k not in columns}
+        if extra:
+            print(f"    {json.dumps(extra, ensure_ascii=False)}")
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,241 @@
+# Импортируется только после того, как __main__ выставил окружение: config читает его при импорте
+from aiohttp import web
+from datetime import datetime, timedelta
+from bench.report import Result
+from config import ADMIN_ID
+from utils.db import init_db_pool, init_db, get_user_cache
+from utils.marzban import get_marzban_token, close_marzban_client
+from utils.yookassa import get_yookassa_client, close_yookassa_client
+from utils.telegram import create_bot
+from utils.update_queue import UpdateQueue
+from utils import broadcast, scheduler
+import aiohttp
+import asyncio
+import main
+import random
+import time
+import uuid
+
+USER_ID_BASE = 1_000_000
+
+
+class BenchApp:
+    # Настоящие обработчики вебхуков из main.py на случайном порту, без SSL и лидерства
+    def __init__(self, marzban):
+        self.marzban = marzban
+        self.url = None
+        self.bot = None
+        self.telegram_latencies = []
+        self._runner = None
+
+    async def start(self):
+        await init_db_pool()
+        await init_db()
+        self.bot = create_bot()
+        self.bot.session.middleware(self._time_request)
+        main.bot = self.bot
+        main.dp = main.create_dispatcher()
+
+        app = web.Application()
+        app.add_routes([
+            web.post("/telegram_webhook", main.telegram_webhook),
+            web.post("/yookassa_webhook", main.yookassa_webhook_handler),
+        ])
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.url = f"http://127.0.0.1:{self._runner.addresses[0][1]}"
+
+    async def _time_request(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            self.telegram_latencies.append(time.perf_counter() - started)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+        if self.bot is not None:
+            await self.bot.session.close()
+        await close_marzban_client()
+        await close_yookassa_client()
+        await (await init_db_pool()).close()
+
+    async def reset(self):
+        # Каждый сценарий начинает с пустых таблиц и пустого Marzban
+        pool = await init_db_pool()
+        async with pool.acquire() as conn:
+            await conn.execute(
+                "TRUNCATE users, invited_users, payments, broadcasts, broadcast_deliveries, "
+                "reminders, menu_messages, pending_payments CASCADE"
+            )
+        get_user_cache().clear()
+        self.marzban.users.clear()
+        self.telegram_latencies.clear()
+
+    async def seed_users(self, count, with_marzban=True):
+        # Смесь состояний: активные, истекающие через 1–3 дня, недавно и давно истёкшие
+        now = datetime.now()
+        pool = await init_db_pool()
+        async with pool.acquire() as conn:
+            await conn.execute(
+                """
+                INSERT INTO users (user_id, subscription_end, referral_link, vpn_key, next_action_at)
+                SELECT id,
+                       CASE
+                           WHEN id % 10 < 4 THEN $2::timestamp + make_interval(days => (id % 80 + 10)::int)
+                           WHEN id % 10 < 6 THEN $2::timestamp + make_interval(days => (id % 3 + 1)::int)
+                               - interval '1 hour'
+                           WHEN id % 10 < 8 THEN $2::timestamp - make_interval(days => (id % 10 + 1)::int)
+                           ELSE $2::timestamp - make_interval(days => (id % 30 + 20)::int)
+                       END,
+                       'https://t.me/finik_vpn_bot?start=ref_' || id,
+                       CASE WHEN id % 4 <> 3 THEN 'https://vpn.bench/sub/user_' || id END,
+                       $2::timestamp
+                FROM generate_series($1::bigint, $1::bigint + $3 - 1) AS id
+                """,
+                USER_ID_BASE, now, count
+            )
+        if with_marzban:
+            long_ago = (datetime.utcnow() - timedelta(days=40)).isoformat()
+            for user_id in range(USER_ID_BASE, USER_ID_BASE + count):
+                if user_id % 4 != 3:
+                    expired_long_ago = user_id % 10 >= 8
+                    self.marzban.add_user(
+                        f"user_{user_id}",
+                        status="active" if user_id % 10 < 6 else "disabled",
+                        online_at=long_ago if expired_long_ago else None
+                    )
+        return list(range(USER_ID_BASE, USER_ID_BASE + count))
+
+
+async def _fire(url, payloads, concurrency, result):
+    # Отправляет POST-запросы с ограничением параллелизма и пишет задержку каждого ответа
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def post(payload):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    async with session.post(url, json=payload) as response:
+                        await response.read()
+                        if response.status != 200:
+                            result.errors += 1
+                except aiohttp.ClientError:
+                    result.errors += 1
+                result.latencies.append(time.perf_counter() - started)
+                result.count += 1
+
+        await asyncio.gather(*(post(payload) for payload in payloads))
+
+
+def _start_update(update_id, user_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"bench{user_id}"},
+            "text": "/start",
+        },
+    }
+
+
+async def webhook_burst(app, updates, concurrency, users, workers, queue_size):
+    # Пачка /start от разных пользователей: задержка ответа вебхука и время до обработки всей очереди
+    await app.reset()
+    main.update_queue = UpdateQueue(main.process_update, workers=workers, maxsize=queue_size, put_timeout=2.0)
+    main.update_queue.start()
+    payloads = [_start_update(i + 1, USER_ID_BASE + i % users) for i in range(updates)]
+    result = Result("webhook_burst")
+    await _fire(f"{app.url}/telegram_webhook", payloads, concurrency, result)
+    acked = time.perf_counter() - result.started_at
+    await main.update_queue.stop(drain_timeout=600)
+    main.update_queue = None
+    result.finish()
+    result.extra = {
+        "ack_s": round(acked, 3),
+        "processed_per_s": round(updates / result.duration, 1),
+        "telegram_calls": len(app.telegram_latencies),
+    }
+    return result
+
+
+async def payment_storm(app, payments, concurrency, duplicate_rate):
+    # Поток успешных оплат от ЮKassa; часть вебхуков приходит повторно и должна отсеяться
+    await app.reset()
+    user_ids = await app.seed_users(payments, with_marzban=False)
+    client = get_yookassa_client()
+    created = await asyncio.gather(*(
+        client.create_payment({
+            "amount": {"value": "149.00", "currency": "RUB"},
+            "capture": True,
+            "confirmation": {"type": "redirect", "return_url": "https://t.me/finik_vpn_bot"},
+            "description": f"Подписка для {user_id}",
+            "metadata": {"user_id": user_id, "days": 30, "order_id": str(uuid.uuid4())},
+        }, str(uuid.uuid4()))
+        for user_id in user_ids
+    ))
+    events = []
+    for payment in created:
+        if payment is None:
+            continue
+        event = {"event": "payment.succeeded", "object": {**payment, "status": "succeeded"}}
+        events.append(event)
+        if random.random() < duplicate_rate:
+            events.append(event)
+    random.shuffle(events)
+    result = Result("payment_storm")
+    await _fire(f"{app.url}/yookassa_webhook", events, concurrency, result)
+    result.finish()
+    pool = await init_db_pool()
+    async with pool.acquire() as conn:
+        processed = await conn.fetchval("SELECT count(*) FROM payments WHERE state = 'processed'")
+    result.extra = {
+        "payments_created": sum(1 for payment in created if payment is not None),
+        "processed": processed,
+        "marzban_creates": app.marzban.calls.get("create_user", 0),
+    }
+    return result
+
+
+async def subscription_sweep(app, users, mode):
+    # Проход по подпискам на синтетической базе: пропускная способность и задержка на пользователя
+    await app.reset()
+    await app.seed_users(users)
+    app.marzban.calls.clear()
+    token = await get_marzban_token()
+    result = Result(f"sweep_{mode}")
+    if mode == "reconcile":
+        result.count = await scheduler.reconcile_subscriptions(token)
+    else:
+        if mode == "due":
+            stats = await scheduler.process_due_users(token)
+        else:
+            stats = await scheduler.process_all_users(token)
+        result.count = stats.processed
+        result.errors = stats.failed + stats.timed_out
+        result.latencies = stats.durations
+    result.finish()
+    result.extra = {"marzban_calls": dict(app.marzban.calls)}
+    return result
+
+
+async def broadcast_run(app, users):
+    # Рассылка по всем пользователям через настоящий broadcast с адаптивным ограничением скорости
+    await app.reset()
+    await app.seed_users(users, with_marzban=False)
+    result = Result("broadcast")
+    broadcast_id = await broadcast.start_broadcast(app.bot, "Бенчмарк рассылки", ADMIN_ID)
+    await broadcast._running[broadcast_id]
+    result.finish()
+    progress = await broadcast.get_broadcast_progress(broadcast_id)
+    result.count = progress["sent"] + progress["failed"] + progress["blocked"]
+    result.errors = progress["failed"]
+    result.latencies = list(app.telegram_latencies)
+    result.extra = {"sent": progress["sent"], "blocked": progress["blocked"]}
+    return result
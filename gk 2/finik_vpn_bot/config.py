@@ -1,5 +1,6 @@
 # finik_vpn_bot/config.py
 from dotenv import load_dotenv
+import json
 import os
 
 # Загружаем переменные из .env
@@ -7,10 +8,98 @@ load_dotenv()
 
 # Получаем значения из переменных окружения
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Свой сервер Bot API (локальный telegram-bot-api или заглушка для нагрузочных тестов)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 DATABASE_URL = os.getenv("DATABASE_URL")
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100))
+# Кэш статусов пользователей в памяти процесса
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 60))  # Секунды
 MARZBAN_URL = os.getenv("MARZBAN_URL")
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD")
 YUKASSA_SHOP_ID = os.getenv("YUKASSA_SHOP_ID")
 YUKASSA_SECRET_KEY = os.getenv("YUKASSA_SECRET_KEY")
-ADMIN_ID = int(os.getenv("ADMIN_ID"))  # Преобразуем в int, так как это число
\ No newline at end of file
+YUKASSA_API_URL = os.getenv("YUKASSA_API_URL", "https://api.yookassa.ru/v3")
+ADMIN_ID = int(os.getenv("ADMIN_ID"))  # Преобразуем в int, так как это число
+
+# Пул соединений с Marzban
+MARZBAN_POOL_LIMIT = int(os.getenv("MARZBAN_POOL_LIMIT", 100))
+MARZBAN_POOL_LIMIT_PER_HOST = int(os.getenv("MARZBAN_POOL_LIMIT_PER_HOST", 20))
+MARZBAN_TIMEOUT = float(os.getenv("MARZBAN_TIMEOUT", 10))
+MARZBAN_INBOUNDS_TTL = int(os.getenv("MARZBAN_INBOUNDS_TTL", 300))  # Секунды
+MARZBAN_PAGE_SIZE = int(os.getenv("MARZBAN_PAGE_SIZE", 500))
+MARZBAN_TOKEN_REFRESH_MARGIN = int(os.getenv("MARZBAN_TOKEN_REFRESH_MARGIN", 300))  # Обновлять токен за N секунд до истечения
+MARZBAN_TOKEN_FALLBACK_TTL = int(os.getenv("MARZBAN_TOKEN_FALLBACK_TTL", 3600))  # Если в токене нет exp
+
+# Режим проверки подписок: due — очередь по users.next_action_at плюс периодическая сверка,
+# reconcile — одна выгрузка из Marzban и сверка в памяти, per_user — запросы к Marzban по каждому пользователю
+SWEEP_MODE = os.getenv("SWEEP_MODE", "due")
+SWEEP_BATCH_SIZE = int(os.getenv("SWEEP_BATCH_SIZE", 100))
+SWEEP_LEASE_MINUTES = int(os.getenv("SWEEP_LEASE_MINUTES", 10))
+SWEEP_MAX_SLEEP = float(os.getenv("SWEEP_MAX_SLEEP", 60))  # Секунды
+SWEEP_CONCURRENCY = int(os.getenv("SWEEP_CONCURRENCY", 50))  # Пользователей в работе одновременно
+SWEEP_USER_TIMEOUT = float(os.getenv("SWEEP_USER_TIMEOUT", 30))  # Секунды на одного пользователя
+RECONCILE_INTERVAL_MINUTES = int(os.getenv("RECONCILE_INTERVAL_MINUTES", 1440))
+# Пороги напоминаний об окончании подписки, дни через запятую, например "3,1"
+REMINDER_DAYS = [int(days) for days in os.getenv("REMINDER_DAYS", "3").split(",") if days.strip()]
+REMINDER_RATE = float(os.getenv("REMINDER_RATE", 20))  # Сообщений в секунду
+# Как часто сверять записанный статус ключа с фактическим в Marzban
+MARZBAN_VERIFY_HOURS = int(os.getenv("MARZBAN_VERIFY_HOURS", 24))
+
+# ЮKassa
+YUKASSA_TIMEOUT = float(os.getenv("YUKASSA_TIMEOUT", 10))
+YUKASSA_MAX_RETRIES = int(os.getenv("YUKASSA_MAX_RETRIES", 3))
+# Сколько секунд повторно показывать ссылку на неоплаченный платёж. ЮKassa отменяет такой платёж
+# примерно через час, поэтому берём с запасом, чтобы пользователь не попал на уже отменённый
+YUKASSA_PENDING_TTL = int(os.getenv("YUKASSA_PENDING_TTL", 3000))
+
+# Рассылки: стартовая скорость (сообщений в секунду) и число одновременных отправок
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+# Как часто лидер подбирает незавершённые рассылки, чей процесс упал
+BROADCAST_RESUME_MINUTES = int(os.getenv("BROADCAST_RESUME_MINUTES", 2))
+
+# Вебхук Telegram: queue — сразу отвечаем 200 и обрабатываем апдейт в фоне, inline — как раньше
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "queue")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 16))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+WEBHOOK_QUEUE_TIMEOUT = float(os.getenv("WEBHOOK_QUEUE_TIMEOUT", 2))  # Секунды ожидания места в очереди
+
+# Быстрый профиль: auto — orjson и uvloop, если установлены; json / asyncio — стандартные, как раньше
+JSON_CODEC = os.getenv("JSON_CODEC", "auto")
+EVENT_LOOP = os.getenv("EVENT_LOOP", "auto")
+
+# Число процессов веб-сервера на одном порту (SO_REUSEPORT); 1 — один процесс, как раньше
+WEB_PROCESSES = int(os.getenv("WEB_PROCESSES", 1))
+# Метрики слушают только 127.0.0.1, процесс N — на METRICS_PORT + N; 0 — метрики отключены
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING")
+# Доля пропускаемых INFO-записей по логгерам, например "utils.marzban=0.1,utils.scheduler=0.2"
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+# Трассировка апдейтов: медленнее TRACE_SLOW_MS попадают в буфер и файл, смотреть через /traces.
+# Выключена по умолчанию: добавляет колбэк на каждый запрос к БД
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "0") == "1"
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", 1000))
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", 200))
+TRACE_FILE = os.getenv("TRACE_FILE", "logs/traces.jsonl")  # Пусто — только буфер в памяти
+# При достижении размера файл трасс переименовывается в .1 (прежний .1 удаляется)
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", 10 * 1024 * 1024))
+
+# Тарифы: id попадает в callback_data "buy_<id>", price — в рублях. Переопределяются JSON-строкой в PLANS
+PLANS = json.loads(os.getenv("PLANS") or "null") or [
+    {"id": "30", "days": 30, "price": 149, "button": "💰 149 ₽ - 1 месяц"},
+    {"id": "90", "days": 90, "price": 370, "button": "💰 370 ₽ - 3 месяца"},
+    {"id": "180", "days": 180, "price": 625, "button": "💰 625 ₽ - 6 месяцев"},
+]
+# Устройства в меню установки: id попадает в callback_data "device_<id>". Переопределяются JSON-строкой в DEVICES
+DEVICES = json.loads(os.getenv("DEVICES") or "null") or [
+    {"id": "iphone", "button": "📱 iPhone", "title": "📱 *Вы выбрали iPhone:*",
+     "download_url": "https://apps.apple.com/kz/app/v2raytun/id6476628951"},
+    {"id": "android", "button": "🤖 Android", "title": "🤖 *Вы выбрали Android:*",
+     "download_url": "https://play.google.com/store/apps/details?id=com.v2raytun.android"},
+    {"id": "mac", "button": "💻 MacBook", "title": "💻 *Вы выбрали MacBook:*",
+     "download_url": "https://apps.apple.com/kz/app/v2raytun/id6476628951"},
+    {"id": "windows", "button": "🖥️ Windows", "title": "🖥️ *Вы выбрали Windows:*",
+     "download_url": "https://ru.ldplayer.net/apps/v2raytun-on-pc.html"},
+]
@@ -1,12 +1,13 @@
 from aiogram import F, Router
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, \
-    CallbackQuery
-from utils.db import get_user_status, register_referral
-from utils.marzban import get_marzban_token, get_available_inbounds, create_vpn_user
+from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from utils.db import get_user_status, register_referral, unblock_user
+from utils.broadcast import start_broadcast, get_broadcast_progress, get_latest_broadcast_id
+from utils.provisioning import provision_vpn_key
+from utils.tracing import get_slow_traces, format_trace
+from utils.catalog import DEVICES_BY_CALLBACK, DEVICES_KEYBOARD, DEVICES_KEYBOARD_WITH_BACK, MAIN_MENU_KEYBOARD, \
+    BUY_KEYBOARD, PLANS_KEYBOARD_NO_BACK
 from config import ADMIN_ID
 import logging
-import asyncio
-from asyncio import gather
 
 logger = logging.getLogger(__name__)
 router = Router()
@@ -21,6 +22,9 @@ async def start_command(message: Message):
 
     username = message.from_user.username or message.from_user.first_name
     status = await get_user_status(user_id)
+    if status:
+        # Пользователь снова пишет боту — возвращаем его в рассылки
+        await unblock_user(user_id)
 
     inline_keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🚀 Начать установку", callback_data="start_install")]
@@ -96,70 +100,34 @@ async def start_install(callback: CallbackQuery):
     logger.info("Нажата кнопка 'Начать установку'", extra=logging_extra)
     await callback.message.delete()
 
-    reply_keyboard = ReplyKeyboardMarkup(
-        resize_keyboard=True,
-        keyboard=[
-            [KeyboardButton(text="💳 Купить"), KeyboardButton(text="📊 Статус")],
-            [KeyboardButton(text="⚙️ Установить"), KeyboardButton(text="🛠️ Тех. поддержка")]
-        ]
-    )
     text = "Выберите устройство:"
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📱 iPhone", callback_data="device_iphone")],
-        [InlineKeyboardButton(text="🤖 Android", callback_data="device_android")],
-        [InlineKeyboardButton(text="💻 MacBook", callback_data="device_mac")],
-        [InlineKeyboardButton(text="🖥️ Windows", callback_data="device_windows")]
-    ])
-    await callback.message.answer(text, reply_markup=reply_keyboard)
-    await callback.message.answer(text, reply_markup=keyboard)
+    await callback.message.answer(text, reply_markup=MAIN_MENU_KEYBOARD)
+    await callback.message.answer(text, reply_markup=DEVICES_KEYBOARD)
 
 
-@router.callback_query(F.data.startswith("device_"))
+@router.callback_query(F.data.in_(DEVICES_BY_CALLBACK))
 async def device_selected(callback: CallbackQuery):
     user_id = callback.from_user.id
-    device = callback.data.split("_")[1]
+    device = DEVICES_BY_CALLBACK[callback.data]
     logging_extra = {"user_id": user_id}
-    logger.info(f"Выбрано устройство {device}", extra=logging_extra)
+    logger.info("Выбрано устройство %s", device.id, extra=logging_extra)
     await callback.message.delete()
 
     status = await get_user_status(user_id)
-    reply_keyboard = ReplyKeyboardMarkup(
-        resize_keyboard=True,
-        keyboard=[
-            [KeyboardButton(text="💳 Купить"), KeyboardButton(text="📊 Статус")],
-            [KeyboardButton(text="⚙️ Установить"), KeyboardButton(text="🛠️ Тех. поддержка")]
-        ]
-    )
-
     if not status["active"]:
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="💳 Купить", callback_data="buy_subscription")]
-        ])
         await callback.message.answer(
             "❌ У вас нет активной подписки. Пополните баланс через 'Купить'.",
-            reply_markup=keyboard
+            reply_markup=BUY_KEYBOARD
         )
         return
 
     if not status["vpn_key"]:
-        token = await get_marzban_token()
-        if not token:
-            logger.error("Не удалось получить токен Marzban", extra=logging_extra)
-            await callback.message.answer("❌ Ошибка сервера. Попробуйте позже.")
-            return
-        username = f"user_{user_id}"
-        inbounds = await get_available_inbounds(token)
-        if not inbounds:
-            logger.error("Не удалось получить inbounds", extra=logging_extra)
-            await callback.message.answer("❌ Ошибка сервера. Обратитесь в техподдержку.")
-            return
-        vpn_key = await create_vpn_user(token, username, inbounds)
-        if not vpn_key or not vpn_key.get("subscription_url"):
+        vpn_key = await provision_vpn_key(user_id)
+        if not vpn_key:
             logger.error("Не удалось создать ключ", extra=logging_extra)
             await callback.message.answer("❌ Ошибка создания ключа. Обратитесь в техподдержку.")
             return
-        await save_vpn_key(user_id, vpn_key["subscription_url"])
-        status = await get_user_status(user_id)
+        status["vpn_key"] = vpn_key["subscription_url"]
 
     v2raytun_url = f"https://apps.artydev.ru/?url=v2raytun://import/{status['vpn_key']}#FinikVPN"
     instruction = (
@@ -167,51 +135,11 @@ async def device_selected(callback: CallbackQuery):
         "1️⃣ Нажми кпопку скачать.\n"
         "2️⃣ Нажми кнопку подключиться!"
     )
-    if device == "iphone":
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📥 Скачать", url="https://apps.apple.com/kz/app/v2raytun/id6476628951")],
-            [InlineKeyboardButton(text="🔗 Подключиться", url=v2raytun_url)],
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_devices")]
-        ])
-        await callback.message.answer(
-            f"📱 *Вы выбрали iPhone:*\n\n{instruction}\n\nВыберите действие:",
-            reply_markup=keyboard,
-            parse_mode="Markdown"
-        )
-    elif device == "android":
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📥 Скачать",
-                                  url="https://play.google.com/store/apps/details?id=com.v2raytun.android")],
-            [InlineKeyboardButton(text="🔗 Подключиться", url=v2raytun_url)],
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_devices")]
-        ])
-        await callback.message.answer(
-            f"🤖 *Вы выбрали Android:*\n\n{instruction}\n\nВыберите действие:",
-            reply_markup=keyboard,
-            parse_mode="Markdown"
-        )
-    elif device == "mac":
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📥 Скачать", url="https://apps.apple.com/kz/app/v2raytun/id6476628951")],
-            [InlineKeyboardButton(text="🔗 Подключиться", url=v2raytun_url)],
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_devices")]
-        ])
-        await callback.message.answer(
-            f"💻 *Вы выбрали MacBook:*\n\n{instruction}\n\nВыберите действие:",
-            reply_markup=keyboard,
-            parse_mode="Markdown"
-        )
-    elif device == "windows":
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="📥 Скачать", url="https://ru.ldplayer.net/apps/v2raytun-on-pc.html")],
-            [InlineKeyboardButton(text="🔗 Подключиться", url=v2raytun_url)],
-            [InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_devices")]
-        ])
-        await callback.message.answer(
-            f"🖥️ *Вы выбрали Windows:*\n\n{instruction}\n\nВыберите действие:",
-            reply_markup=keyboard,
-            parse_mode="Markdown"
-        )
+    await callback.message.answer(
+        f"{device.title}\n\n{instruction}\n\nВыберите действие:",
+        reply_markup=device.keyboard(v2raytun_url),
+        parse_mode="Markdown"
+    )
 
 
 @router.callback_query(F.data == "buy_subscription")
@@ -221,12 +149,7 @@ async def buy_subscription_callback(callback: CallbackQuery):
     logger.info("Нажата инлайн-кнопка 'Купить'", extra=logging_extra)
     await callback.message.delete()
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💰 149 ₽ - 1 месяц", callback_data="buy_30")],
-        [InlineKeyboardButton(text="💰 370 ₽ - 3 месяца", callback_data="buy_90")],
-        [InlineKeyboardButton(text="💰 625 ₽ - 6 месяцев", callback_data="buy_180")]
-    ])
-    await callback.message.answer("Выберите подписку:", reply_markup=keyboard)
+    await callback.message.answer("Выберите подписку:", reply_markup=PLANS_KEYBOARD_NO_BACK)
     await callback.answer()
 
 
@@ -237,14 +160,7 @@ async def back_to_devices(callback: CallbackQuery):
     logger.info("Нажата кнопка 'Назад'", extra=logging_extra)
     await callback.message.delete()
 
-    text = "Выберите устройство:"
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📱 iPhone", callback_data="device_iphone")],
-        [InlineKeyboardButton(text="🤖 Android", callback_data="device_android")],
-        [InlineKeyboardButton(text="💻 MacBook", callback_data="device_mac")],
-        [InlineKeyboardButton(text="🖥️ Windows", callback_data="device_windows")]
-    ])
-    await callback.message.answer(text, reply_markup=keyboard)
+    await callback.message.answer("Выберите устройство:", reply_markup=DEVICES_KEYBOARD)
 
 
 @router.callback_query(F.data == "clear_message")
@@ -277,15 +193,58 @@ async def install_handler(message: Message):
     logger.info("Нажата кнопка 'Установить'", extra=logging_extra)
     await message.delete()
 
-    text = "Выберите устройство:"
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📱 iPhone", callback_data="device_iphone")],
-        [InlineKeyboardButton(text="🤖 Android", callback_data="device_android")],
-        [InlineKeyboardButton(text="💻 MacBook", callback_data="device_mac")],
-        [InlineKeyboardButton(text="🖥️ Windows", callback_data="device_windows")],
-        [InlineKeyboardButton(text="⬅️ Назад", callback_data="clear_message")]
-    ])
-    await message.answer(text, reply_markup=keyboard)
+    await message.answer("Выберите устройство:", reply_markup=DEVICES_KEYBOARD_WITH_BACK)
+
+
+@router.message(F.text.startswith("/broadcast_status"))
+async def broadcast_status_command(message: Message):
+    user_id = message.from_user.id
+    if user_id != ADMIN_ID:
+        await message.reply("Эта команда доступна только администратору!")
+        return
+
+    args = message.text.split(maxsplit=1)
+    try:
+        broadcast_id = int(args[1]) if len(args) > 1 else await get_latest_broadcast_id()
+    except ValueError:
+        await message.reply("Укажите номер рассылки, например: /broadcast_status 3")
+        return
+    progress = await get_broadcast_progress(broadcast_id) if broadcast_id else None
+    if not progress:
+        await message.reply("Рассылка не найдена.")
+        return
+
+    await message.reply(
+        f"Рассылка #{progress['broadcast_id']}: {progress['state']}\n"
+        f"Всего: {progress['total']}\n"
+        f"Осталось: {progress['pending']}\n"
+        f"Успешно: {progress['sent']}\n"
+        f"Не удалось: {progress['failed']}\n"
+        f"Заблокировали бота: {progress['blocked']}"
+    )
+
+
+@router.message(F.text.startswith("/traces"))
+async def traces_command(message: Message):
+    # Последние медленные апдейты с разбивкой времени по вызовам Telegram, БД, Marzban и ЮKassa
+    if message.from_user.id != ADMIN_ID:
+        await message.reply("Эта команда доступна только администратору!")
+        return
+
+    args = message.text.split(maxsplit=1)
+    try:
+        limit = min(int(args[1]), 20) if len(args) > 1 else 5
+    except ValueError:
+        await message.reply("Укажите число трасс, например: /traces 5")
+        return
+    traces = await get_slow_traces(limit)
+    if not traces:
+        await message.reply("Медленных апдейтов пока нет.")
+        return
+
+    text = "\n\n".join(format_trace(entry) for entry in reversed(traces))
+    # Ограничение Telegram на длину сообщения
+    await message.reply(text[:4000])
 
 
 @router.message(F.text.startswith("/broadcast"))
@@ -306,39 +265,12 @@ async def broadcast_command(message: Message):
     broadcast_message = broadcast_text[1]
     logger.info(f"Начало рассылки от user_id={user_id}: {broadcast_message}", extra=logging_extra)
 
-    from utils.db import init_db_pool
-    pool = await init_db_pool()
-    async with pool.acquire() as conn:
-        users = await conn.fetch("SELECT user_id FROM users")
-
-    success_count = 0
-    fail_count = 0
-    batch_size = 20  # Максимум 20 сообщений в секунду для Telegram
-    user_ids = [user["user_id"] for user in users]
-
-    # Обрабатываем пользователей группами по 20
-    for i in range(0, len(user_ids), batch_size):
-        batch = user_ids[i:i + batch_size]
-        tasks = []
-        for uid in batch:
-            tasks.append(message.bot.send_message(uid, broadcast_message))
-
-        # Параллельная отправка в пределах группы
-        results = await gather(*tasks, return_exceptions=True)
-
-        for result in results:
-            if isinstance(result, Exception):
-                logger.error(f"Ошибка отправки пользователю: {str(result)}", extra=logging_extra)
-                fail_count += 1
-            else:
-                success_count += 1
-
-        # Задержка между группами для соблюдения лимита в 20 сообщений/сек
-        if i + batch_size < len(user_ids):
-            await asyncio.sleep(1)  # 1 секунда между группами
-
-    await message.reply(f"Рассылка завершена!\nУспешно: {success_count}\nНе удалось: {fail_count}")
-    logger.info(f"Рассылка завершена: Успешно={success_count}, Не удалось={fail_count}", extra=logging_extra)
+    # Рассылка идёт фоновым заданием; итог придёт отдельным сообщением
+    broadcast_id = await start_broadcast(message.bot, broadcast_message, user_id)
+    await message.reply(
+        f"Рассылка #{broadcast_id} запущена.\n"
+        f"Прогресс: /broadcast_status {broadcast_id}"
+    )
 
 
 def setup_start_handlers(dp: Router):
@@ -1,56 +1,69 @@
-from aiogram import Bot, Dispatcher
+from aiogram import Dispatcher
 from aiogram.types import Update
 from handlers.start import setup_start_handlers
 from handlers.status import setup_status_handlers
 from handlers.subscription import setup_subscription_handlers
 from handlers.subscription import proc_payment
-from utils.scheduler import check_subscriptions, setup_scheduler
-from utils.db import init_db_pool, init_db
-from config import TELEGRAM_BOT_TOKEN
+from utils.scheduler import check_subscriptions, setup_scheduler, scheduler, start_due_loop, stop_due_loop
+from utils.db import init_db_pool, init_db, start_cache_sync, stop_cache_sync, clear_pending_payment
+from utils.leader import LeaderElection
+from utils.marzban import get_marzban_client, get_inbound_registry, get_token_manager, close_marzban_client
+from utils.yookassa import get_yookassa_client, close_yookassa_client
+from utils.broadcast import resume_broadcasts
+from utils.reminders import start_reminder_sender, stop_reminder_sender
+from utils.update_queue import UpdateQueue, update_key
+from utils.telegram import create_bot
+from utils.tracing import TracingMiddleware
+from utils.metrics import HandlerMetricsMiddleware, metrics_handler, track_queue_depth
+from utils.runtime import run, json_loads
+from utils.log import setup_logging, stop_logging, current_user_id, current_update_id
+from config import WEBHOOK_MODE, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE, WEBHOOK_QUEUE_TIMEOUT, \
+    WEB_PROCESSES, SWEEP_MODE, METRICS_PORT, LOG_LEVEL, LOG_SAMPLING, TRACE_ENABLED, BROADCAST_RESUME_MINUTES
 import asyncio
+from decimal import Decimal
 import logging
-import logging.handlers
+import multiprocessing
 from aiohttp import web
 import os
+import signal
 import ssl
+import time
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.WARNING)
-formatter = logging.Formatter(
-    "%(asctime)s [%(levelname)s] [user_id:%(user_id)s] %(message)s",
-    defaults={"user_id": "N/A"}
-)
-
-log_dir = "logs"
-os.makedirs(log_dir, exist_ok=True)
-file_handler = logging.handlers.RotatingFileHandler(
-    os.path.join(log_dir, "bot.log"),
-    maxBytes=10 * 1024 * 1024,
-    backupCount=5
-)
-file_handler.setFormatter(formatter)
-memory_handler = logging.handlers.MemoryHandler(
-    capacity=1024,
-    flushLevel=logging.ERROR,
-    target=file_handler
-)
-memory_handler.setFormatter(formatter)
-logging.getLogger().addHandler(memory_handler)
+
+# У каждого рабочего процесса свой файл, чтобы ротация не конфликтовала
+worker_index = os.getenv("WORKER_INDEX")
+log_file = f"bot.worker{worker_index}.log" if worker_index else "bot.log"
+setup_logging("logs", log_file, level=LOG_LEVEL, sampling=LOG_SAMPLING)
 
 bot = None
 dp = None
+update_queue = None
+
+async def process_update(update: Update):
+    # Все записи лога, сделанные при обработке апдейта, получают его update_id и user_id
+    current_update_id.set(update.update_id)
+    current_user_id.set(update_key(update))
+    await dp.feed_update(bot, update)
 
 # Обработчик вебхука Telegram
 async def telegram_webhook(request):
-    update = Update(**await request.json())
-    await dp.process_update(update)
+    # Апдейт валидируется прямо из байтов тела, без промежуточного dict
+    update = Update.model_validate_json(await request.read(), context={"bot": bot})
+    if update_queue is None:
+        await process_update(update)
+        return web.Response(text="OK", status=200)
+    # Быстрый ответ: апдейт уходит в очередь, Telegram не ждёт обработчик
+    if not await update_queue.submit(update):
+        return web.Response(text="Busy", status=503)
     return web.Response(text="OK", status=200)
 
 # Обработчик вебхука ЮKassa
 async def yookassa_webhook_handler(request):
     try:
-        data = await request.json()
-        logger.info(f"Получен вебхук от ЮKassa: {data}")
+        data = await request.json(loads=json_loads)
+        # Полезная нагрузка форматируется, только если INFO действительно пишется
+        logger.info("Получен вебхук от ЮKassa: %s", data)
 
         event = data.get("event")
         payment_object = data.get("object", {})
@@ -60,18 +73,21 @@ async def yookassa_webhook_handler(request):
         user_id = int(metadata.get("user_id"))
         days = int(metadata.get("days"))
         order_id = metadata.get("order_id")
+        amount = payment_object.get("amount", {}).get("value")
+        amount = Decimal(amount) if amount else None
 
         if event == "payment.succeeded" and status == "succeeded":
-            logger.info(f"Платеж {payment_id} успешен для пользователя {user_id}")
-            await proc_payment(user_id, days, order_id, payment_id)
+            logger.info("Платеж %s успешен", payment_id, extra={"user_id": user_id})
+            await proc_payment(user_id, days, order_id, payment_id, amount)
         elif event == "payment.canceled" and status == "canceled":
-            logger.info(f"Платеж {payment_id} отменен для пользователя {user_id}")
+            logger.info("Платеж %s отменен", payment_id, extra={"user_id": user_id})
+            await clear_pending_payment(payment_id)
             await bot.send_message(user_id, "Ваш платеж был отменен.")
 
         return web.Response(text="OK", status=200)
 
-    except Exception as e:
-        logger.error(f"Ошибка обработки вебхука: {e}")
+    except Exception:
+        logger.exception("Ошибка обработки вебхука ЮKassa")
         return web.Response(text="Error", status=500)
 
 # Настройка веб-сервера
@@ -91,35 +107,153 @@ async def setup_web_server():
     )
 
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', 443, ssl_context=ssl_context)
+    # reuse_port позволяет нескольким процессам слушать один порт, ядро распределяет соединения
+    site = web.TCPSite(runner, '0.0.0.0', 443, ssl_context=ssl_context, reuse_port=WEB_PROCESSES > 1)
     await site.start()
     logger.info("Веб-сервер запущен на порту 443")
 
+    if METRICS_PORT:
+        # Метрики не публикуются на внешнем порту 443; у каждого процесса свой локальный порт
+        metrics_port = METRICS_PORT + int(os.getenv("WORKER_INDEX", 0))
+        metrics_app = web.Application()
+        metrics_app.add_routes([web.get('/metrics', metrics_handler)])
+        metrics_runner = web.AppRunner(metrics_app)
+        await metrics_runner.setup()
+        await web.TCPSite(metrics_runner, '127.0.0.1', metrics_port).start()
+        logger.info(f"Метрики доступны на 127.0.0.1:{metrics_port}/metrics")
+
 # Установка вебхука Telegram
 async def set_telegram_webhook():
     webhook_url = "https://webhook.finik.online/telegram_webhook"
     await bot.set_webhook(webhook_url)
     logger.info(f"Вебхук Telegram установлен: {webhook_url}")
 
+def create_dispatcher():
+    dispatcher = Dispatcher()
+    if TRACE_ENABLED:
+        dispatcher.update.outer_middleware(TracingMiddleware())
+    # Внутренние middleware диспетчера наследуются всеми вложенными роутерами
+    dispatcher.message.middleware(HandlerMetricsMiddleware())
+    dispatcher.callback_query.middleware(HandlerMetricsMiddleware())
+
+    setup_start_handlers(dispatcher)
+    setup_status_handlers(dispatcher)
+    setup_subscription_handlers(dispatcher)
+    return dispatcher
+
+async def on_leader_elected():
+    # Планировщик, начальная проверка подписок, установка вебхука и рассылки — только в лидере
+    if scheduler.running:
+        scheduler.resume()
+    else:
+        await setup_scheduler()
+        # Рассылку ведёт процесс, получивший /broadcast. Если он упал, лидер не меняется, поэтому
+        # незавершённые рассылки подбираются периодически; живую рассылку держит её advisory-блокировка
+        scheduler.add_job(resume_broadcasts, "interval", minutes=BROADCAST_RESUME_MINUTES, args=[bot])
+        await set_telegram_webhook()
+    start_reminder_sender(bot)
+    if SWEEP_MODE == "due":
+        start_due_loop()
+    else:
+        await check_subscriptions()
+    await resume_broadcasts(bot)
+
+async def on_leader_lost():
+    if scheduler.running:
+        scheduler.pause()
+    await stop_due_loop()
+    await stop_reminder_sender()
+
 async def main():
-    global bot, dp
+    global bot, dp, update_queue
     logger.info("Инициализация бота")
     await init_db_pool()
     await init_db()
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
-    dp = Dispatcher()
+    if WEB_PROCESSES > 1:
+        await start_cache_sync()
+    get_marzban_client()
+    get_token_manager().start()
+    get_inbound_registry().start()
+    get_yookassa_client()
+    bot = create_bot()
+    dp = create_dispatcher()
 
-    setup_start_handlers(dp)
-    setup_status_handlers(dp)
-    setup_subscription_handlers(dp)
+    if WEBHOOK_MODE == "queue":
+        update_queue = UpdateQueue(
+            process_update,
+            workers=WEBHOOK_WORKERS,
+            maxsize=WEBHOOK_QUEUE_SIZE,
+            put_timeout=WEBHOOK_QUEUE_TIMEOUT
+        )
+        update_queue.start()
+        track_queue_depth(update_queue)
 
-    await setup_scheduler()
-    await check_subscriptions()
-
-    await set_telegram_webhook()
     await setup_web_server()
+    leader = LeaderElection(on_leader_elected, on_leader_lost)
+    leader.start()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop_event.set)
+
+    try:
+        await stop_event.wait()
+    finally:
+        await leader.stop()
+        await stop_due_loop()
+        await stop_reminder_sender()
+        if update_queue is not None:
+            await update_queue.stop()
+        await stop_cache_sync()
+        await close_marzban_client()
+        await close_yookassa_client()
+        stop_logging()
+
+def run_worker(index):
+    try:
+        run(main())
+    except KeyboardInterrupt:
+        pass
+
+def supervise(processes_count):
+    # Процессы ничего не разделяют: у каждого свой event loop, пулы соединений и очередь апдейтов.
+    # Общее состояние (платежи, сообщения меню, лидерство) живёт в Postgres
+    ctx = multiprocessing.get_context("spawn")
+    processes = {}
+    stopping = False
+
+    def spawn(index):
+        os.environ["WORKER_INDEX"] = str(index)
+        process = ctx.Process(target=run_worker, args=(index,), name=f"worker-{index}")
+        process.start()
+        processes[index] = process
+        logger.info(f"Запущен процесс worker-{index}, pid={process.pid}")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(processes_count):
+        spawn(index)
+
+    while not stopping:
+        for index, process in list(processes.items()):
+            if not process.is_alive():
+                logger.error(f"Процесс worker-{index} завершился с кодом {process.exitcode}, перезапускаем")
+                spawn(index)
+        time.sleep(1)
 
-    await asyncio.Event().wait()
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        process.join(timeout=15)
+    stop_logging()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if WEB_PROCESSES > 1:
+        supervise(WEB_PROCESSES)
+    else:
+        run(main())
\ No newline at end of file
@@ -0,0 +1,252 @@
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from config import BROADCAST_RATE, BROADCAST_CONCURRENCY, DATABASE_URL
+from utils.db import init_db_pool, transaction
+import asyncio
+import asyncpg
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Запущенные в этом процессе рассылки: broadcast_id -> asyncio.Task
+_running = {}
+# Счётчики текущего прогона: broadcast_id -> {"sent": .., "failed": .., "blocked": ..}
+_progress = {}
+
+FLUSH_SIZE = 100
+PAGE_SIZE = 500
+# Пространство ключей advisory-lock рассылок: одну рассылку ведёт только один процесс
+BROADCAST_LOCK_NS = 734
+MAX_SEND_ATTEMPTS = 5
+
+
+class AdaptiveRateLimiter:
+    # Темп отправки: после RetryAfter замедляемся вдвое и ждём указанное время,
+    # затем постепенно разгоняемся обратно до максимума
+    def __init__(self, max_rate, min_rate=1.0):
+        self._max_rate = max_rate
+        self._min_rate = min_rate
+        self._rate = max_rate
+        self._next_at = 0.0
+        self._lock = asyncio.Lock()
+
+    @property
+    def rate(self):
+        return self._rate
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_at - now
+            if delay > 0:
+                await asyncio.sleep(delay)
+                now = time.monotonic()
+            self._next_at = max(self._next_at, now) + 1 / self._rate
+
+    def on_retry_after(self, retry_after):
+        self._rate = max(self._min_rate, self._rate / 2)
+        self._next_at = time.monotonic() + retry_after
+        logger.warning(f"Telegram RetryAfter {retry_after}s, скорость рассылки снижена до {self._rate:.1f}/с")
+
+    def on_success(self):
+        if self._rate < self._max_rate:
+            self._rate = min(self._max_rate, self._rate + 0.1)
+
+
+async def create_broadcast(text, created_by):
+    # Задание и список получателей создаются на сервере одной транзакцией, без выгрузки user_id в память
+    async with transaction() as conn:
+        broadcast_id = await conn.fetchval(
+            "INSERT INTO broadcasts (text, created_by) VALUES ($1, $2) RETURNING broadcast_id",
+            text, created_by
+        )
+        await conn.execute(
+            "INSERT INTO broadcast_deliveries (broadcast_id, user_id) "
+            "SELECT $1, user_id FROM users WHERE NOT blocked",
+            broadcast_id
+        )
+    return broadcast_id
+
+
+async def get_broadcast_progress(broadcast_id):
+    pool = await init_db_pool()
+    async with pool.acquire() as conn:
+        broadcast = await conn.fetchrow(
+            "SELECT broadcast_id, state, created_at, finished_at FROM broadcasts WHERE broadcast_id = $1",
+            broadcast_id
+        )
+        if not broadcast:
+            return None
+        rows = await conn.fetch(
+            "SELECT state, COUNT(*) AS count FROM broadcast_deliveries WHERE broadcast_id = $1 GROUP BY state",
+            broadcast_id
+        )
+    counts = {row["state"]: row["count"] for row in rows}
+    return {
+        "broadcast_id": broadcast["broadcast_id"],
+        "state": broadcast["state"],
+        "created_at": broadcast["created_at"],
+        "finished_at": broadcast["finished_at"],
+        "total": sum(counts.values()),
+        "pending": counts.get("pending", 0),
+        "sent": counts.get("sent", 0),
+        "failed": counts.get("failed", 0),
+        "blocked": counts.get("blocked", 0),
+    }
+
+
+async def get_latest_broadcast_id():
+    pool = await init_db_pool()
+    async with pool.acquire() as conn:
+        return await conn.fetchval("SELECT max(broadcast_id) FROM broadcasts")
+
+
+async def _flush(broadcast_id, results):
+    if not results:
+        return
+    user_ids = [user_id for user_id, _ in results]
+    states = [state for _, state in results]
+    blocked = [user_id for user_id, state in results if state == "blocked"]
+    async with transaction() as conn:
+        await conn.execute(
+            "UPDATE broadcast_deliveries AS d SET state = v.state, updated_at = now() "
+            "FROM unnest($2::bigint[], $3::text[]) AS v(user_id, state) "
+            "WHERE d.broadcast_id = $1 AND d.user_id = v.user_id",
+            broadcast_id, user_ids, states
+        )
+        if blocked:
+            await conn.execute("UPDATE users SET blocked = TRUE WHERE user_id = ANY($1::bigint[])", blocked)
+
+
+async def _send_one(bot: Bot, limiter, user_id, text):
+    for _ in range(MAX_SEND_ATTEMPTS):
+        await limiter.acquire()
+        try:
+            await bot.send_message(user_id, text)
+            limiter.on_success()
+            return "sent"
+        except TelegramRetryAfter as e:
+            limiter.on_retry_after(e.retry_after)
+        except TelegramForbiddenError:
+            return "blocked"
+        except TelegramBadRequest as e:
+            logger.error(f"Ошибка отправки пользователю {user_id}: {e}")
+            return "failed"
+        except Exception as e:
+            logger.error(f"Ошибка отправки пользователю {user_id}: {e}")
+            return "failed"
+    return "failed"
+
+
+async def _run_broadcast(bot: Bot, broadcast_id, notify_chat_id=None):
+    pool = await init_db_pool()
+    async with pool.acquire() as conn:
+        text = await conn.fetchval("SELECT text FROM broadcasts WHERE broadcast_id = $1", broadcast_id)
+    limiter = AdaptiveRateLimiter(BROADCAST_RATE)
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    progress = _progress.setdefault(broadcast_id, {"sent": 0, "failed": 0, "blocked": 0})
+    results = []
+    tasks = set()
+
+    async def deliver(user_id):
+        try:
+            state = await _send_one(bot, limiter, user_id, text)
+            progress[state] += 1
+            results.append((user_id, state))
+        finally:
+            semaphore.release()
+
+    logger.info(f"Старт рассылки #{broadcast_id}")
+    # Сессионная блокировка на отдельном соединении вне пула, как у выборов лидера: рассылка идёт часами,
+    # а простаивающее соединение без транзакции не держит снимок и не мешает vacuum
+    lock_conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        if not await lock_conn.fetchval("SELECT pg_try_advisory_lock($1, $2)", BROADCAST_LOCK_NS, broadcast_id):
+            logger.info(f"Рассылку #{broadcast_id} уже ведёт другой процесс")
+            return
+        # Пока ждали блокировку, прежний владелец мог закончить рассылку
+        state = await lock_conn.fetchval("SELECT state FROM broadcasts WHERE broadcast_id = $1", broadcast_id)
+        if state != "running":
+            return
+        # Получатели читаются страницами по ключу: каждая страница — короткий отдельный запрос
+        last_user_id = 0
+        while True:
+            async with pool.acquire() as conn:
+                page = await conn.fetch(
+                    "SELECT user_id FROM broadcast_deliveries "
+                    "WHERE broadcast_id = $1 AND state = 'pending' AND user_id > $2 "
+                    "ORDER BY user_id LIMIT $3",
+                    broadcast_id, last_user_id, PAGE_SIZE
+                )
+            for record in page:
+                await semaphore.acquire()
+                task = asyncio.create_task(deliver(record["user_id"]))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                if len(results) >= FLUSH_SIZE:
+                    batch, results[:] = results[:], []
+                    await _flush(broadcast_id, batch)
+            if len(page) < PAGE_SIZE:
+                break
+            last_user_id = page[-1]["user_id"]
+        # Дожидаемся отправок, пока блокировка рассылки ещё удерживается
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        await _flush(broadcast_id, results)
+        # Завершение отмечаем до снятия блокировки, чтобы лидер не подхватил уже законченную рассылку
+        await lock_conn.execute(
+            "UPDATE broadcasts SET state = 'done', finished_at = now() WHERE broadcast_id = $1",
+            broadcast_id
+        )
+    finally:
+        # Закрытие соединения снимает сессионную блокировку
+        await lock_conn.close()
+
+    # Итог берём из базы: счётчики процесса не включают доставки до перезапуска или до смены воркера
+    summary = await get_broadcast_progress(broadcast_id)
+    logger.info(
+        f"Рассылка #{broadcast_id} завершена: Успешно={summary['sent']}, "
+        f"Не удалось={summary['failed']}, Заблокировали бота={summary['blocked']}"
+    )
+    if notify_chat_id:
+        await bot.send_message(
+            notify_chat_id,
+            f"Рассылка #{broadcast_id} завершена!\nУспешно: {summary['sent']}\n"
+            f"Не удалось: {summary['failed']}\nЗаблокировали бота: {summary['blocked']}"
+        )
+
+
+def _start(bot: Bot, broadcast_id, notify_chat_id=None):
+    if broadcast_id in _running:
+        return _running[broadcast_id]
+
+    async def runner():
+        try:
+            await _run_broadcast(bot, broadcast_id, notify_chat_id)
+        except Exception as e:
+            logger.error(f"Рассылка #{broadcast_id} прервана: {e}")
+        finally:
+            _running.pop(broadcast_id, None)
+            _progress.pop(broadcast_id, None)
+
+    task = asyncio.create_task(runner())
+    _running[broadcast_id] = task
+    return task
+
+
+async def start_broadcast(bot: Bot, text, created_by):
+    broadcast_id = await create_broadcast(text, created_by)
+    _start(bot, broadcast_id, notify_chat_id=created_by)
+    return broadcast_id
+
+
+async def resume_broadcasts(bot: Bot):
+    # Продолжаем незавершённые рассылки с непосланных получателей: после рестарта и периодически
+    # в лидере. Рассылку, которую ещё ведёт живой процесс, пропустит её advisory-блокировка
+    pool = await init_db_pool()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("SELECT broadcast_id, created_by FROM broadcasts WHERE state = 'running'")
+    for row in rows:
+        logger.info(f"Возобновляем рассылку #{row['broadcast_id']}")
+        _start(bot, row["broadcast_id"], notify_chat_id=row["created_by"])
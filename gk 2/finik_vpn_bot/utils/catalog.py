@@ -0,0 +1,141 @@
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import Optional
+from config import PLANS, DEVICES
+
+# Каталог тарифов и меню собирается один раз при импорте: клавиатуры и заготовки платежей
+# переиспользуются во всех нажатиях, а тарифы меняются в конфиге без правки кода
+
+BUY_PREFIX = "buy_"
+DEVICE_PREFIX = "device_"
+# Эти callback_data уже заняты другими кнопками и не могут быть id тарифа или устройства
+_RESERVED_CALLBACKS = {"buy_subscription"}
+
+BACK_TO_MENU_BUTTON = InlineKeyboardButton(text="⬅️ Назад", callback_data="clear_message")
+BACK_TO_PLANS_BUTTON = InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_subscriptions")
+BACK_TO_DEVICES_BUTTON = InlineKeyboardButton(text="⬅️ Назад", callback_data="back_to_devices")
+
+MAIN_MENU_KEYBOARD = ReplyKeyboardMarkup(
+    resize_keyboard=True,
+    keyboard=[
+        [KeyboardButton(text="💳 Купить"), KeyboardButton(text="📊 Статус")],
+        [KeyboardButton(text="⚙️ Установить"), KeyboardButton(text="🛠️ Тех. поддержка")]
+    ]
+)
+BUY_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="💳 Купить", callback_data="buy_subscription")]
+])
+
+
+@dataclass(frozen=True)
+class Plan:
+    id: str
+    days: int
+    price: Decimal
+    button: str
+    # Неизменяемая часть запроса к ЮKassa; на каждый платёж добавляются только description и metadata
+    payload: dict
+    payment_text: str
+
+    @property
+    def callback_data(self):
+        return f"{BUY_PREFIX}{self.id}"
+
+    def payment_payload(self, user_id, order_id):
+        return {
+            **self.payload,
+            "description": f"Подписка на {self.days} дней для user_{user_id}",
+            "metadata": {"user_id": str(user_id), "days": str(self.days), "order_id": order_id},
+        }
+
+
+@dataclass(frozen=True)
+class Device:
+    id: str
+    button: str
+    title: str
+    download_button: InlineKeyboardButton
+
+    @property
+    def callback_data(self):
+        return f"{DEVICE_PREFIX}{self.id}"
+
+    def keyboard(self, connect_url):
+        # Меняется только кнопка подключения с ключом пользователя; остальные кнопки общие
+        return InlineKeyboardMarkup(inline_keyboard=[
+            [self.download_button],
+            [InlineKeyboardButton(text="🔗 Подключиться", url=connect_url)],
+            [BACK_TO_DEVICES_BUTTON]
+        ])
+
+
+def _build_plan(data):
+    # Через str, чтобы цена из JSON вида 199.9 не превратилась в неточный float; ЮKassa ждёт ровно две цифры после точки
+    price_value = Decimal(str(data["price"])).quantize(Decimal("0.01"))
+    price = {"value": str(price_value), "currency": "RUB"}
+    return Plan(
+        id=str(data["id"]),
+        days=int(data["days"]),
+        price=price_value,
+        button=data["button"],
+        payload={
+            "amount": price,
+            "confirmation": {"type": "redirect", "return_url": "https://t.me/finik_vpn_bot"},
+            "capture": True,
+            "receipt": {
+                "customer": {"email": "support@finik.online"},
+                "items": [
+                    {
+                        "description": f"Подписка на {data['days']} дней",
+                        "quantity": "1.00",
+                        "amount": price,
+                        "vat_code": 1,
+                        "payment_subject": "service",
+                        "payment_mode": "full_payment"
+                    }
+                ]
+            }
+        },
+        payment_text=f"Оплата {data['days']} дней: {data['price']} рублей"
+    )
+
+
+def _build_device(data):
+    return Device(
+        id=data["id"],
+        button=data["button"],
+        title=data["title"],
+        download_button=InlineKeyboardButton(text="📥 Скачать", url=data["download_url"])
+    )
+
+
+def _index(items):
+    index = {}
+    for item in items:
+        if item.callback_data in _RESERVED_CALLBACKS or item.callback_data in index:
+            raise ValueError(f"Недопустимый или повторяющийся id в каталоге: {item.id}")
+        index[item.callback_data] = item
+    return index
+
+
+PLANS_BY_CALLBACK = _index([_build_plan(plan) for plan in PLANS])
+DEVICES_BY_CALLBACK = _index([_build_device(device) for device in DEVICES])
+
+_plan_rows = [[InlineKeyboardButton(text=plan.button, callback_data=plan.callback_data)]
+              for plan in PLANS_BY_CALLBACK.values()]
+PLANS_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=_plan_rows + [[BACK_TO_MENU_BUTTON]])
+PLANS_KEYBOARD_NO_BACK = InlineKeyboardMarkup(inline_keyboard=_plan_rows)
+
+_device_rows = [[InlineKeyboardButton(text=device.button, callback_data=device.callback_data)]
+                for device in DEVICES_BY_CALLBACK.values()]
+DEVICES_KEYBOARD = InlineKeyboardMarkup(inline_keyboard=_device_rows)
+DEVICES_KEYBOARD_WITH_BACK = InlineKeyboardMarkup(inline_keyboard=_device_rows + [[BACK_TO_MENU_BUTTON]])
+
+
+def get_plan(callback_data) -> Optional[Plan]:
+    return PLANS_BY_CALLBACK.get(callback_data)
+
+
+def get_device(callback_data) -> Optional[Device]:
+    return DEVICES_BY_CALLBACK.get(callback_data)
@@ -1,75 +1,249 @@
 import asyncpg
-from config import DATABASE_URL
-from datetime import datetime, timedelta
+from config import DATABASE_URL, DB_STATEMENT_CACHE_SIZE, USER_CACHE_SIZE, USER_CACHE_TTL, TRACE_ENABLED
+from utils.migrations import run_migrations
+from utils.metrics import DB_POOL_WAIT, track_db_pool
+from utils.tracing import record_span, on_query
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime
+import asyncio
 import logging
-from aiocache import cached
-from aiocache.serializers import PickleSerializer
+import os
+import time
 
 logger = logging.getLogger(__name__)
 
 _db_pool = None
 
+REFERRAL_BONUS_DAYS = 3
+
+# Горячие запросы держим в константах: asyncpg кэширует подготовленный оператор
+# на каждом соединении пула по тексту запроса, поэтому текст должен совпадать байт в байт
+SQL_GET_USER = (
+    "SELECT user_id, subscription_end, invited, referral_link, vpn_key "
+    "FROM users WHERE user_id = $1"
+)
+# next_action_at = сейчас: планировщик сразу пересчитает напоминания и срок по новой дате
+SQL_EXTEND_SUBSCRIPTION = (
+    "UPDATE users SET subscription_end = COALESCE(subscription_end, $3) + make_interval(days => $2), "
+    "next_action_at = $3 "
+    "WHERE user_id = $1 "
+    "RETURNING user_id, subscription_end, invited, referral_link, vpn_key"
+)
+SQL_SAVE_VPN_KEY = "UPDATE users SET vpn_key = $1 WHERE user_id = $2"
+# Регистрация одним запросом: пользователь, связь с пригласившим и его счётчик invited.
+# Счётчик растёт только на реально вставленную связь, поэтому повтор и гонка его не задваивают
+SQL_REGISTER_REFERRAL = (
+    "WITH new_user AS ("
+    "INSERT INTO users (user_id, subscription_end, referral_link, vpn_key) VALUES ($2, NULL, $3, NULL) "
+    "ON CONFLICT (user_id) DO NOTHING RETURNING user_id"
+    "), referral AS ("
+    "INSERT INTO invited_users (referrer_id, invited_user_id, bonus_activated) "
+    "SELECT $1::bigint, $2, FALSE "
+    "WHERE $1::bigint <> $2 AND EXISTS (SELECT 1 FROM users WHERE user_id = $1::bigint) "
+    "ON CONFLICT DO NOTHING RETURNING referrer_id"
+    "), counter AS ("
+    "UPDATE users SET invited = invited + 1 WHERE user_id IN (SELECT referrer_id FROM referral) RETURNING user_id"
+    ") "
+    "SELECT EXISTS (SELECT 1 FROM new_user) AS created, EXISTS (SELECT 1 FROM counter) AS referred"
+)
+# Все ожидающие бонусы оплатившего пользователя: отмечаем и продлеваем пригласивших одним запросом
+SQL_ACTIVATE_REFERRAL_BONUSES = (
+    "WITH activated AS ("
+    "UPDATE invited_users SET bonus_activated = TRUE "
+    "WHERE invited_user_id = $1 AND bonus_activated = FALSE RETURNING referrer_id"
+    ") "
+    "UPDATE users SET subscription_end = COALESCE(subscription_end, $3) + make_interval(days => $2), "
+    "next_action_at = $3 "
+    "WHERE user_id IN (SELECT referrer_id FROM activated) "
+    "RETURNING user_id"
+)
+# Забираем наступившие задачи пачкой и сдвигаем их на время аренды, чтобы другой процесс их не взял
+SQL_CLAIM_DUE_USERS = (
+    "UPDATE users SET next_action_at = $2 "
+    "WHERE user_id IN ("
+    "SELECT user_id FROM users WHERE next_action_at <= $1 "
+    "ORDER BY next_action_at LIMIT $3 FOR UPDATE SKIP LOCKED"
+    ") "
+    "RETURNING user_id, subscription_end, invited, referral_link, vpn_key, marzban_status, marzban_synced_at"
+)
+
+
+class UserCache:
+    # LRU с TTL для строк users: хранит сырые поля, статус считается при чтении,
+    # поэтому active/days_left всегда актуальны относительно текущего времени
+    def __init__(self, maxsize=10000, ttl=60):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._items = OrderedDict()
+
+    def get(self, user_id):
+        item = self._items.get(user_id)
+        if item is None:
+            return None
+        expires_at, row = item
+        if expires_at < time.monotonic():
+            del self._items[user_id]
+            return None
+        self._items.move_to_end(user_id)
+        return row
+
+    def put(self, user_id, row):
+        self._items[user_id] = (time.monotonic() + self._ttl, dict(row))
+        self._items.move_to_end(user_id)
+        while len(self._items) > self._maxsize:
+            self._items.popitem(last=False)
+
+    def invalidate(self, *user_ids):
+        for user_id in user_ids:
+            self._items.pop(user_id, None)
+
+    def clear(self):
+        self._items.clear()
+
+
+_user_cache = UserCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# Соединение внутри transaction() -> user_id, которые нужно сбросить из кэша после её завершения.
+# Запись заводит и удаляет сама transaction(), поэтому ничего не остаётся после её выхода
+_pending_invalidations = {}
+
+# Синхронизация кэшей между процессами через LISTEN/NOTIFY (включается в многопроцессном режиме)
+CACHE_CHANNEL = "user_cache"
+_cache_listener = None
+_background_tasks = set()
+
+def get_user_cache():
+    return _user_cache
+
+async def _notify_peers(payload):
+    try:
+        async with _connection() as conn:
+            await conn.execute("SELECT pg_notify($1, $2)", CACHE_CHANNEL, payload)
+    except Exception as e:
+        logger.error(f"Ошибка рассылки сброса кэша: {e}")
+
+def _publish(user_ids):
+    if _cache_listener is None or not user_ids:
+        return
+    payload = f"{os.getpid()}:" + ",".join(str(user_id) for user_id in user_ids)
+    task = asyncio.get_running_loop().create_task(_notify_peers(payload))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+def _on_cache_notify(connection, pid, channel, payload):
+    sender, _, user_ids = payload.partition(":")
+    if sender == str(os.getpid()):
+        return
+    _user_cache.invalidate(*(int(user_id) for user_id in user_ids.split(",") if user_id))
+
+def _on_cache_listener_lost(connection):
+    global _user_cache
+    # Без канала сбросов кэш может отдавать чужие устаревшие данные — отключаем его
+    logger.error("Соединение синхронизации кэша потеряно, кэш статусов отключён")
+    _user_cache = UserCache(maxsize=0, ttl=0)
+
+async def start_cache_sync():
+    global _cache_listener
+    if _cache_listener is None:
+        _cache_listener = await asyncpg.connect(DATABASE_URL)
+        await _cache_listener.add_listener(CACHE_CHANNEL, _on_cache_notify)
+        _cache_listener.add_termination_listener(_on_cache_listener_lost)
+
+async def stop_cache_sync():
+    global _cache_listener
+    if _cache_listener is not None:
+        await _cache_listener.close()
+        _cache_listener = None
+
+def _invalidate(conn, *user_ids):
+    _user_cache.invalidate(*user_ids)
+    # Между сбросом и коммитом кто-то мог снова закэшировать старую строку — сбросим ещё раз после коммита.
+    # Откладываем только внутри transaction(); в прочих случаях рассылаем сброс сразу
+    pending = _pending_invalidations.get(conn) if conn is not None else None
+    if pending is not None and conn.is_in_transaction():
+        pending.update(user_ids)
+    else:
+        _publish(user_ids)
+
+def _cache_put(user_id, row):
+    _user_cache.put(user_id, row)
+    _publish((user_id,))
+
+def _cache_write(user_id, row, conn):
+    # Внутри внешней транзакции запись может откатиться, поэтому кэш только сбрасываем
+    if row is not None and conn is None:
+        _cache_put(user_id, row)
+    else:
+        _invalidate(conn, user_id)
+
+class _TimedPool:
+    # Обёртка пула asyncpg: замеряет ожидание свободного соединения, остальное передаёт пулу
+    def __init__(self, pool):
+        self._pool = pool
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+    @asynccontextmanager
+    async def acquire(self, *, timeout=None):
+        started = time.perf_counter()
+        async with self._pool.acquire(timeout=timeout) as conn:
+            DB_POOL_WAIT.observe(time.perf_counter() - started)
+            record_span("db acquire", started)
+            yield conn
+
+async def _init_connection(conn):
+    # Каждый запрос соединения становится спаном трассы текущего апдейта
+    conn.add_query_logger(on_query)
+
 async def init_db_pool():
     global _db_pool
     if _db_pool is None:
-        _db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=5, max_size=20)
+        pool = await asyncpg.create_pool(
+            DATABASE_URL, min_size=5, max_size=20,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            init=_init_connection if TRACE_ENABLED else None
+        )
+        track_db_pool(pool)
+        _db_pool = _TimedPool(pool)
     return _db_pool
 
-async def init_db():
+@asynccontextmanager
+async def _connection(conn=None):
+    # Переданное соединение используется как есть, иначе берём своё из пула
+    if conn is not None:
+        yield conn
+        return
     pool = await init_db_pool()
-    async with pool.acquire() as conn:
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                subscription_end TIMESTAMP,
-                invited INTEGER DEFAULT 0,
-                referral_link TEXT,
-                vpn_key TEXT
-            )
-        ''')
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS invited_users (
-                referrer_id BIGINT,
-                invited_user_id BIGINT,
-                PRIMARY KEY (referrer_id, invited_user_id),
-                FOREIGN KEY (referrer_id) REFERENCES users(user_id),
-                FOREIGN KEY (invited_user_id) REFERENCES users(user_id),
-                bonus_activated BOOLEAN DEFAULT FALSE
-            )
-        ''')
-
-async def add_user(user_id):
-    pool = await init_db_pool()
-    async with pool.acquire() as conn:
-        referral_link = f"https://t.me/finik_vpn_bot?start=ref_{user_id}"
-        await conn.execute(
-            "INSERT INTO users (user_id, subscription_end, referral_link, vpn_key) "
-            "VALUES ($1, NULL, $2, NULL) ON CONFLICT (user_id) DO NOTHING",
-            user_id, referral_link
-        )
+    async with pool.acquire() as acquired:
+        yield acquired
 
-async def extend_subscription(user_id, days):
-    pool = await init_db_pool()
-    async with pool.acquire() as conn:
-        current_end = await conn.fetchval("SELECT subscription_end FROM users WHERE user_id = $1", user_id)
-        new_end = (current_end or datetime.now()) + timedelta(days=days)
-        await conn.execute("UPDATE users SET subscription_end = $1 WHERE user_id = $2", new_end, user_id)
+@asynccontextmanager
+async def transaction(conn=None):
+    # Единица работы: все хелперы, получившие этот conn, выполняются в одной транзакции
+    async with _connection(conn) as c:
+        # Вложенная transaction() на том же соединении копит сбросы во внешнюю, сбрасывает внешняя
+        outermost = c not in _pending_invalidations
+        if outermost:
+            _pending_invalidations[c] = set()
+        try:
+            async with c.transaction():
+                yield c
+        finally:
+            if outermost:
+                user_ids = _pending_invalidations.pop(c)
+                _user_cache.invalidate(*user_ids)
+                _publish(tuple(user_ids))
 
-async def save_vpn_key(user_id, vpn_key):
-    pool = await init_db_pool()
-    async with pool.acquire() as conn:
-        await conn.execute("UPDATE users SET vpn_key = $1 WHERE user_id = $2", vpn_key, user_id)
+async def init_db():
+    async with _connection() as conn:
+        await run_migrations(conn)
 
-async def get_user_status(user_id):
-    pool = await init_db_pool()
-    async with pool.acquire() as conn:
-        user = await conn.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
-    if not user:
-        return None
+def _build_status(user):
     sub_end = user["subscription_end"]
     active = sub_end and sub_end > datetime.now()
     days_left = (sub_end - datetime.now()).days if sub_end and active else 0
-    status = {
+    return {
         "active": active,
         "days_left": days_left,
         "subscription_end": sub_end.strftime("%Y-%m-%d %H:%M:%S") if sub_end else None,
@@ -77,73 +251,233 @@ async def get_user_status(user_id):
         "referral_link": user["referral_link"],
         "vpn_key": user.get("vpn_key", None)
     }
-    return status
 
-async def register_referral(referrer_id, invited_user_id):
-    pool = await init_db_pool()
-    async with pool.acquire() as conn:
+async def add_user(user_id, conn=None):
+    async with _connection(conn) as c:
+        referral_link = f"https://t.me/finik_vpn_bot?start=ref_{user_id}"
+        await c.execute(
+            "INSERT INTO users (user_id, subscription_end, referral_link, vpn_key) "
+            "VALUES ($1, NULL, $2, NULL) ON CONFLICT (user_id) DO NOTHING",
+            user_id, referral_link
+        )
+    _invalidate(conn, user_id)
+
+async def extend_subscription(user_id, days, conn=None):
+    # Один UPDATE ... RETURNING вместо SELECT + UPDATE; возвращает новый статус пользователя
+    async with _connection(conn) as c:
+        user = await c.fetchrow(SQL_EXTEND_SUBSCRIPTION, user_id, days, datetime.now())
+    _cache_write(user_id, user, conn)
+    return _build_status(user) if user else None
+
+async def save_vpn_key(user_id, vpn_key, conn=None):
+    async with _connection(conn) as c:
+        await c.execute(SQL_SAVE_VPN_KEY, vpn_key, user_id)
+    cached = _user_cache.get(user_id)
+    if cached is not None and conn is None:
+        _cache_put(user_id, {**cached, "vpn_key": vpn_key})
+    else:
+        _invalidate(conn, user_id)
+
+async def save_vpn_keys(keys, conn=None):
+    # keys: список пар (user_id, vpn_key); одно UPDATE на весь список
+    if not keys:
+        return
+    user_ids = [user_id for user_id, _ in keys]
+    vpn_keys = [vpn_key for _, vpn_key in keys]
+    async with _connection(conn) as c:
+        await c.execute(
+            "UPDATE users AS u SET vpn_key = v.vpn_key "
+            "FROM unnest($1::bigint[], $2::text[]) AS v(user_id, vpn_key) "
+            "WHERE u.user_id = v.user_id",
+            user_ids, vpn_keys
+        )
+    _invalidate(conn, *user_ids)
+
+async def get_subscribed_users(conn=None):
+    async with _connection(conn) as conn:
+        return await conn.fetch(
+            "SELECT user_id, subscription_end, vpn_key, marzban_status FROM users WHERE subscription_end IS NOT NULL"
+        )
+
+async def iter_users(expiring_before, expired_after, page_size=500):
+    # Страницы по user_id, каждая отдельным коротким запросом: полный проход не держит
+    # ни соединение, ни транзакцию всё время обработки
+    last_user_id = 0
+    while True:
+        async with _connection() as conn:
+            page = await conn.fetch(
+                "SELECT user_id, subscription_end, marzban_status, marzban_synced_at FROM users "
+                "WHERE user_id > $1 AND subscription_end IS NOT NULL "
+                "AND (subscription_end < $2 OR subscription_end > $3) "
+                "ORDER BY user_id LIMIT $4",
+                last_user_id, expiring_before, expired_after, page_size
+            )
+        for row in page:
+            yield row
+        if len(page) < page_size:
+            return
+        last_user_id = page[-1]["user_id"]
+
+async def claim_due_users(now, lease_until, limit, conn=None):
+    async with _connection(conn) as conn:
+        rows = await conn.fetch(SQL_CLAIM_DUE_USERS, now, lease_until, limit)
+    return [
+        {
+            "user_id": row["user_id"],
+            "subscription_end": row["subscription_end"],
+            "marzban_status": row["marzban_status"],
+            "marzban_synced_at": row["marzban_synced_at"],
+            "lease_until": lease_until,
+            "status": _build_status(row)
+        }
+        for row in rows
+    ]
+
+async def set_next_action(user_id, next_action_at, lease_until, conn=None):
+    # Пишем, только если строка всё ещё на нашей аренде: оплата во время обработки ставит
+    # next_action_at = now, и пользователь должен быть обработан заново со свежим статусом
+    async with _connection(conn) as conn:
+        result = await conn.execute(
+            "UPDATE users SET next_action_at = $2 WHERE user_id = $1 AND next_action_at = $3",
+            user_id, next_action_at, lease_until
+        )
+    return result != "UPDATE 0"
+
+async def record_marzban_states(states, conn=None):
+    # states: список пар (user_id, статус, который мы последним применили в Marzban; None — ключ удалён)
+    if not states:
+        return
+    async with _connection(conn) as conn:
+        await conn.execute(
+            "UPDATE users AS u SET marzban_status = v.status, marzban_synced_at = $3 "
+            "FROM unnest($1::bigint[], $2::text[]) AS v(user_id, status) "
+            "WHERE u.user_id = v.user_id",
+            [user_id for user_id, _ in states],
+            [status for _, status in states],
+            datetime.now()
+        )
+
+async def get_next_due_at(conn=None):
+    async with _connection(conn) as conn:
+        return await conn.fetchval("SELECT min(next_action_at) FROM users WHERE next_action_at IS NOT NULL")
+
+async def unblock_user(user_id, conn=None):
+    async with _connection(conn) as conn:
+        await conn.execute("UPDATE users SET blocked = FALSE WHERE user_id = $1 AND blocked", user_id)
+
+async def get_user_status(user_id, conn=None):
+    user = _user_cache.get(user_id) if conn is None else None
+    if user is None:
+        async with _connection(conn) as c:
+            user = await c.fetchrow(SQL_GET_USER, user_id)
+        if not user:
+            return None
+        if conn is None:
+            _user_cache.put(user_id, user)
+    return _build_status(user)
+
+async def register_referral(referrer_id, invited_user_id, conn=None):
+    # True, если связь с пригласившим создана этим вызовом
+    referral_link = f"https://t.me/finik_vpn_bot?start=ref_{invited_user_id}"
+    async with _connection(conn) as c:
         try:
-            async with conn.transaction():
-                existing_user = await conn.fetchval("SELECT user_id FROM users WHERE user_id = $1", invited_user_id)
-                if not existing_user:
-                    referral_link = f"https://t.me/finik_vpn_bot?start=ref_{invited_user_id}"
-                    await conn.execute(
-                        "INSERT INTO users (user_id, subscription_end, referral_link, vpn_key) "
-                        "VALUES ($1, NULL, $2, NULL)", invited_user_id, referral_link
-                    )
-
-                if referrer_id is None or referrer_id == invited_user_id:
-                    return False
-
-                already_invited = await conn.fetchval(
-                    "SELECT COUNT(*) FROM invited_users WHERE referrer_id = $1 AND invited_user_id = $2",
-                    referrer_id, invited_user_id
-                )
-                if already_invited == 0:
-                    await conn.execute(
-                        "INSERT INTO invited_users (referrer_id, invited_user_id, bonus_activated) "
-                        "VALUES ($1, $2, FALSE) ON CONFLICT DO NOTHING",
-                        referrer_id, invited_user_id
-                    )
-                    await conn.execute(
-                        "UPDATE users SET invited = invited + 1 WHERE user_id = $1",
-                        referrer_id
-                    )
-                    logger.info(f"Реферал зарегистрирован: referrer_id={referrer_id}, invited_user_id={invited_user_id}")
-                    return True
-                logger.info(f"Реферал уже зарегистрирован: referrer_id={referrer_id}, invited_user_id={invited_user_id}")
-                return False
+            row = await c.fetchrow(SQL_REGISTER_REFERRAL, referrer_id, invited_user_id, referral_link)
         except Exception as e:
             logger.error(f"Ошибка регистрации реферала: {str(e)}")
             return False
+    if row["created"]:
+        _invalidate(conn, invited_user_id)
+    if referrer_id is None:
+        return False
+    if row["referred"]:
+        logger.info(f"Реферал зарегистрирован: referrer_id={referrer_id}, invited_user_id={invited_user_id}")
+        # У пригласившего изменился счётчик invited
+        _invalidate(conn, referrer_id)
+        return True
+    logger.info(f"Реферал не зарегистрирован: referrer_id={referrer_id}, invited_user_id={invited_user_id}")
+    return False
 
-async def activate_referral_bonus(referrer_id, invited_user_id):
-    pool = await init_db_pool()
-    async with pool.acquire() as conn:
-        try:
-            async with conn.transaction():
-                bonus_exists = await conn.fetchval(
-                    "SELECT bonus_activated FROM invited_users WHERE referrer_id = $1 AND invited_user_id = $2",
-                    referrer_id, invited_user_id
-                )
-                if bonus_exists is False:
-                    await conn.execute(
-                        "UPDATE invited_users SET bonus_activated = TRUE WHERE referrer_id = $1 AND invited_user_id = $2",
-                        referrer_id, invited_user_id
-                    )
-                    await extend_subscription(referrer_id, 3)
-                    logger.info(f"Бонус 3 дня начислен для referrer_id={referrer_id}")
-                    return True
-                logger.info(f"Бонус уже активирован для referrer_id={referrer_id}, invited_user_id={invited_user_id}")
-                return False
-        except Exception as e:
-            logger.error(f"Ошибка активации бонуса: {str(e)}")
-            return False
+async def activate_referral_bonuses(invited_user_id, days=REFERRAL_BONUS_DAYS, conn=None):
+    # Возвращает user_id пригласивших, которым бонус начислен этим вызовом, — их нужно уведомить
+    async with _connection(conn) as c:
+        rows = await c.fetch(SQL_ACTIVATE_REFERRAL_BONUSES, invited_user_id, days, datetime.now())
+    referrer_ids = [row["user_id"] for row in rows]
+    if referrer_ids:
+        _invalidate(conn, *referrer_ids)
+        logger.info(f"Бонус {days} дня начислен для referrer_id={referrer_ids}")
+    return referrer_ids
 
-async def get_invited_count(referrer_id):
-    pool = await init_db_pool()
-    async with pool.acquire() as conn:
+async def claim_payment(payment_id, order_id, user_id, days, amount, conn=None):
+    # Одна условная вставка: True только для первой доставки вебхука с этим payment_id
+    async with _connection(conn) as conn:
+        claimed = await conn.fetchval(
+            "INSERT INTO payments (payment_id, order_id, user_id, days, amount, state) "
+            "VALUES ($1, $2, $3, $4, $5, 'processing') "
+            "ON CONFLICT (payment_id) DO NOTHING RETURNING payment_id",
+            payment_id, order_id, user_id, days, amount
+        )
+    return claimed is not None
+
+async def set_payment_state(payment_id, state, conn=None):
+    async with _connection(conn) as conn:
+        await conn.execute(
+            "UPDATE payments SET state = $1, updated_at = now() WHERE payment_id = $2",
+            state, payment_id
+        )
+
+async def get_pending_payment(user_id, plan_id, conn=None):
+    async with _connection(conn) as conn:
+        return await conn.fetchrow(
+            "SELECT payment_id, order_id, confirmation_url FROM pending_payments "
+            "WHERE user_id = $1 AND plan_id = $2 AND expires_at > LOCALTIMESTAMP",
+            user_id, plan_id
+        )
+
+async def save_pending_payment(user_id, plan_id, payment_id, order_id, confirmation_url, ttl, conn=None):
+    # Новый платёж по тому же тарифу заменяет прежний (например, истёкший)
+    async with _connection(conn) as conn:
+        await conn.execute(
+            "INSERT INTO pending_payments (user_id, plan_id, payment_id, order_id, confirmation_url, expires_at) "
+            "VALUES ($1, $2, $3, $4, $5, LOCALTIMESTAMP + make_interval(secs => $6)) "
+            "ON CONFLICT (user_id, plan_id) DO UPDATE SET payment_id = EXCLUDED.payment_id, "
+            "order_id = EXCLUDED.order_id, confirmation_url = EXCLUDED.confirmation_url, "
+            "expires_at = EXCLUDED.expires_at",
+            user_id, plan_id, payment_id, order_id, confirmation_url, ttl
+        )
+
+async def clear_pending_payment(payment_id, conn=None):
+    # Платёж оплачен или отменён — ссылку на него больше не показываем
+    async with _connection(conn) as conn:
+        await conn.execute("DELETE FROM pending_payments WHERE payment_id = $1", payment_id)
+
+async def set_menu_messages(user_id, subscription_msg_id, payment_msg_id, conn=None):
+    async with _connection(conn) as conn:
+        await conn.execute(
+            "INSERT INTO menu_messages (user_id, subscription_msg_id, payment_msg_id) VALUES ($1, $2, $3) "
+            "ON CONFLICT (user_id) DO UPDATE SET subscription_msg_id = EXCLUDED.subscription_msg_id, "
+            "payment_msg_id = EXCLUDED.payment_msg_id, updated_at = now()",
+            user_id, subscription_msg_id, payment_msg_id
+        )
+
+async def set_payment_message(user_id, payment_msg_id, conn=None):
+    async with _connection(conn) as conn:
+        await conn.execute(
+            "INSERT INTO menu_messages (user_id, payment_msg_id) VALUES ($1, $2) "
+            "ON CONFLICT (user_id) DO UPDATE SET payment_msg_id = EXCLUDED.payment_msg_id, updated_at = now()",
+            user_id, payment_msg_id
+        )
+
+async def pop_menu_messages(user_id, conn=None):
+    async with _connection(conn) as conn:
+        row = await conn.fetchrow(
+            "DELETE FROM menu_messages WHERE user_id = $1 RETURNING subscription_msg_id, payment_msg_id",
+            user_id
+        )
+    return dict(row) if row else None
+
+async def get_invited_count(referrer_id, conn=None):
+    async with _connection(conn) as conn:
         count = await conn.fetchval(
             "SELECT COUNT(*) FROM invited_users WHERE referrer_id = $1", referrer_id
         )
-    return count
\ No newline at end of file
+    return count
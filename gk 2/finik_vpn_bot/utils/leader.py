@@ -0,0 +1,63 @@
+import asyncpg
+import asyncio
+import logging
+from config import DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-lock лидера: только держатель блокировки запускает планировщик
+LEADER_LOCK_ID = 7_340_002
+
+
+class LeaderElection:
+    # Лидер — процесс, удерживающий сессионную advisory-блокировку на отдельном соединении.
+    # Если процесс умирает, соединение закрывается, блокировка освобождается и её забирает другой
+    def __init__(self, on_elected, on_lost=None, retry_interval=10.0):
+        self._on_elected = on_elected
+        self._on_lost = on_lost
+        self._retry_interval = retry_interval
+        self._conn = None
+        self._task = None
+        self.is_leader = False
+
+    async def _try_acquire(self):
+        if self._conn is None or self._conn.is_closed():
+            self._conn = await asyncpg.connect(DATABASE_URL)
+        return await self._conn.fetchval("SELECT pg_try_advisory_lock($1)", LEADER_LOCK_ID)
+
+    async def _run(self):
+        while True:
+            try:
+                if not self.is_leader:
+                    if await self._try_acquire():
+                        self.is_leader = True
+                        logger.info("Процесс избран лидером")
+                        await self._on_elected()
+                else:
+                    # Проверяем, что соединение с блокировкой живо
+                    await self._conn.fetchval("SELECT 1")
+            except Exception as e:
+                logger.error(f"Ошибка выборов лидера: {e}")
+                if self.is_leader:
+                    self.is_leader = False
+                    logger.warning("Лидерство потеряно")
+                    if self._on_lost is not None:
+                        await self._on_lost()
+                if self._conn is not None:
+                    self._conn.terminate()
+                    self._conn = None
+            await asyncio.sleep(self._retry_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+        self.is_leader = False
@@ -0,0 +1,114 @@
+from contextvars import ContextVar
+from datetime import datetime, timezone
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+
+# Контекст текущего апдейта: попадает в каждую запись лога, пока обрабатывается апдейт
+current_user_id = ContextVar("current_user_id", default=None)
+current_update_id = ContextVar("current_update_id", default=None)
+
+_listener = None
+
+
+class ContextFilter(logging.Filter):
+    # Выполняется в потоке вызова: только здесь видны contextvars задачи-обработчика
+    def filter(self, record):
+        if getattr(record, "user_id", None) is None:
+            record.user_id = current_user_id.get()
+        if getattr(record, "update_id", None) is None:
+            record.update_id = current_update_id.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    # Пропускает только долю INFO/DEBUG записей указанных логгеров; WARNING и выше проходят всегда
+    def __init__(self, rates):
+        super().__init__()
+        self._rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self._rates:
+            return True
+        name = record.name
+        while name:
+            rate = self._rates.get(name)
+            if rate is not None:
+                return random.random() < rate
+            name = name.rpartition(".")[0]
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # Стандартный QueueHandler форматирует сообщение ещё в event loop; здесь запись уходит
+    # в очередь как есть, и %-аргументы подставляются уже в потоке QueueListener
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "user_id": getattr(record, "user_id", None),
+            "update_id": getattr(record, "update_id", None),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def parse_sampling(value):
+    # "utils.marzban=0.1,utils.scheduler=0.5" -> {"utils.marzban": 0.1, "utils.scheduler": 0.5}
+    rates = {}
+    for item in (value or "").split(","):
+        name, _, rate = item.strip().partition("=")
+        if name and rate:
+            rates[name] = float(rate)
+    return rates
+
+
+def setup_logging(log_dir, log_file, level="WARNING", sampling=None):
+    # Файл и консоль пишет отдельный поток QueueListener; event loop только кладёт запись в очередь
+    global _listener
+    os.makedirs(log_dir, exist_ok=True)
+    file_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(log_dir, log_file),
+        maxBytes=10 * 1024 * 1024,
+        backupCount=5,
+        encoding="utf-8"
+    )
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(
+        "%(asctime)s [%(levelname)s] [user_id:%(user_id)s] %(name)s: %(message)s"
+    ))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(parse_sampling(sampling)))
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(
+        log_queue, file_handler, console_handler, respect_handler_level=True
+    )
+    _listener.start()
+
+
+def stop_logging():
+    # Дописывает накопленные записи; вызывается при остановке процесса
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
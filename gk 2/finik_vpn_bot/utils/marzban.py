@@ -1,118 +1,476 @@
 import aiohttp
+import asyncio
+import base64
+import hashlib
+import json
 import logging
-from config import MARZBAN_URL, ADMIN_USERNAME, ADMIN_PASSWORD
-from aiocache import cached
+import time
+from dataclasses import dataclass
+from typing import Optional
+from config import (
+    MARZBAN_URL, ADMIN_USERNAME, ADMIN_PASSWORD,
+    MARZBAN_POOL_LIMIT, MARZBAN_POOL_LIMIT_PER_HOST, MARZBAN_TIMEOUT, MARZBAN_INBOUNDS_TTL,
+    MARZBAN_PAGE_SIZE, MARZBAN_TOKEN_REFRESH_MARGIN, MARZBAN_TOKEN_FALLBACK_TTL
+)
+from utils.metrics import marzban_endpoint, observe_external
+from utils.tracing import record_span
+from utils.runtime import json_loads, json_dumps
 
 logger = logging.getLogger(__name__)
 
-@cached(ttl=3600)  # Кэшируем токен на 1 час
-async def get_marzban_token():
-    payload = {"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD}
-    logger.info(f"Попытка получить токен с MARZBAN_URL={MARZBAN_URL}")
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            f"{MARZBAN_URL}/api/admin/token",
+
+class MarzbanError(RuntimeError):
+    # Marzban не ответил или ответил ошибкой: в отличие от 404, о пользователе ничего не известно
+    pass
+
+
+@dataclass(frozen=True)
+class Inbound:
+    tag: str
+    protocol: str
+    network: Optional[str] = None
+    tls: Optional[str] = None
+    port: Optional[int] = None
+
+
+@dataclass(frozen=True)
+class InboundTopology:
+    by_protocol: dict
+    fingerprint: str
+
+    @classmethod
+    def from_payload(cls, data):
+        by_protocol = {}
+        for protocol, items in (data or {}).items():
+            by_protocol[protocol] = tuple(
+                Inbound(
+                    tag=item["tag"],
+                    protocol=item.get("protocol", protocol),
+                    network=item.get("network"),
+                    tls=item.get("tls"),
+                    port=item.get("port")
+                )
+                for item in items
+            )
+        # Отпечаток топологии — по нему видно, что набор inbound'ов изменился
+        parts = sorted(f"{i.protocol}:{i.tag}:{i.network}:{i.tls}:{i.port}"
+                       for items in by_protocol.values() for i in items)
+        fingerprint = hashlib.sha1("|".join(parts).encode()).hexdigest()
+        return cls(by_protocol=by_protocol, fingerprint=fingerprint)
+
+    def first(self, protocol) -> Optional[Inbound]:
+        items = self.by_protocol.get(protocol)
+        return items[0] if items else None
+
+
+class MarzbanClient:
+    # Одна долгоживущая сессия с пулом keep-alive соединений вместо новой сессии на каждый вызов
+    def __init__(self, base_url, limit=100, limit_per_host=20, timeout=10.0):
+        self._base_url = base_url.rstrip("/")
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._limit,
+                limit_per_host=self._limit_per_host,
+                keepalive_timeout=60,
+                ssl=False
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=self._timeout, json_serialize=json_dumps
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _send(self, method, path, token=None, timeout=None, **kwargs):
+        # Возвращает (status, body); при сетевой ошибке или таймауте — (None, None).
+        # На 401 один раз обновляет токен и повторяет запрос, незаметно для вызывающего
+        status, data = await self._request(method, path, token, timeout, **kwargs)
+        if status == 401 and token:
+            fresh = await get_token_manager().refresh(stale=token)
+            if fresh and fresh != token:
+                logger.info("Токен Marzban отклонён на %s %s, повторяем с новым", method, path)
+                status, data = await self._request(method, path, fresh, timeout, **kwargs)
+        return status, data
+
+    async def _request(self, method, path, token=None, timeout=None, **kwargs):
+        headers = dict(kwargs.pop("headers", {}))
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+        endpoint = marzban_endpoint(method, path)
+        started = time.perf_counter()
+        try:
+            async with self._get_session().request(
+                method, f"{self._base_url}{path}", headers=headers, **kwargs
+            ) as response:
+                if response.content_type == "application/json":
+                    body = await response.json(loads=json_loads)
+                else:
+                    body = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error(f"Ошибка запроса к Marzban {method} {path}: {e!r}")
+            observe_external("marzban", endpoint, started, "network")
+            record_span(f"marzban {endpoint}", started, "network")
+            return None, None
+        error = str(response.status) if response.status >= 400 else None
+        observe_external("marzban", endpoint, started, error)
+        record_span(f"marzban {endpoint}", started, error)
+        return response.status, body
+
+    async def get_token(self):
+        payload = {"username": ADMIN_USERNAME, "password": ADMIN_PASSWORD}
+        logger.info("Попытка получить токен с MARZBAN_URL=%s", self._base_url)
+        status, data = await self._send(
+            "POST", "/api/admin/token",
             data=payload,
-            headers={"Content-Type": "application/x-www-form-urlencoded"},
-            ssl=False
-        ) as response:
-            logger.info(f"Статус ответа от Marzban: {response.status}")
-            if response.status == 200:
-                data = await response.json()
-                return data["access_token"]
-            logger.error(f"Ошибка получения токена: {response.status} - {await response.text()}")
-            return None
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
+        logger.info("Статус ответа от Marzban: %s", status)
+        if status == 200:
+            return data["access_token"]
+        logger.error(f"Ошибка получения токена: {status} - {data}")
+        return None
 
-async def get_available_inbounds(token):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            f"{MARZBAN_URL}/api/inbounds",
-            headers={"Authorization": f"Bearer {token}"},
-            ssl=False
-        ) as response:
-            if response.status == 200:
-                data = await response.json()
-                logger.info(f"Доступные inbounds: {data}")
-                return data
-            logger.error(f"Ошибка получения inbound'ов: {response.status} - {await response.text()}")
+    async def get_inbounds(self, token):
+        status, data = await self._send("GET", "/api/inbounds", token)
+        if status == 200:
+            logger.info("Доступные inbounds: %s", data)
+            return data
+        logger.error(f"Ошибка получения inbound'ов: {status} - {data}")
+        return None
+
+    async def get_user(self, token, username):
+        # None — пользователя нет в Marzban; сетевая ошибка или 5xx бросает MarzbanError
+        status, data = await self._send("GET", f"/api/user/{username}", token)
+        logger.info("Ответ на запрос данных %s: %s", username, status)
+        if status == 200:
+            return data
+        elif status == 404:
+            logger.info("Пользователь %s не найден в Marzban", username)
             return None
+        raise MarzbanError(f"Ошибка получения данных пользователя {username}: {status}")
 
-async def get_vpn_user(token, username):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            f"{MARZBAN_URL}/api/user/{username}",
-            headers={"Authorization": f"Bearer {token}"},
-            ssl=False
-        ) as response:
-            logger.info(f"Ответ на запрос данных {username}: {response.status}")
-            if response.status == 200:
-                return await response.json()
-            elif response.status == 404:
-                logger.info(f"Пользователь {username} не найден в Marzban")
-                return None
-            logger.error(f"Ошибка получения данных пользователя {username}: {response.status}")
+    async def list_users(self, token, offset=0, limit=500):
+        status, data = await self._send(
+            "GET", "/api/users", token, params={"offset": offset, "limit": limit}
+        )
+        if status == 200:
+            return data
+        logger.error(f"Ошибка получения списка пользователей: {status} - {data}")
+        return None
+
+    async def iter_users(self, token, page_size=500):
+        # Постранично обходит всех пользователей Marzban; при ошибке бросает MarzbanError,
+        # чтобы вызывающий не принял неполный список за полный
+        offset = 0
+        while True:
+            page = await self.list_users(token, offset, page_size)
+            if page is None:
+                raise MarzbanError(f"Не удалось получить страницу пользователей offset={offset}")
+            users = page.get("users", [])
+            for user in users:
+                yield user
+            offset += len(users)
+            if not users or offset >= page.get("total", 0):
+                return
+
+    async def create_user(self, token, username, inbounds: InboundTopology):
+        vless = inbounds.first("vless") if inbounds else None
+        if not vless:
+            logger.error(f"Нет доступных vless inbound'ов для создания пользователя {username}")
             return None
+        inbound = {"vless": [vless.tag]}
+        status, data = await self._send(
+            "POST", "/api/user", token,
+            json={"username": username, "proxies": {"vless": {}}, "inbounds": inbound}
+        )
+        if status == 200:
+            return data
+        if status == 409:
+            # Пользователя уже создал параллельный процесс — создание идемпотентно, берём существующего
+            logger.info("Пользователь %s уже существует в Marzban, переиспользуем", username)
+            return await self.get_user(token, username)
+        logger.error(f"Ошибка создания пользователя {username}: {status} - {data}")
+        if status in (400, 404, 422) and "inbound" in str(data).lower():
+            # Закэшированный inbound больше не существует — перечитаем топологию
+            get_inbound_registry().invalidate()
+        return None
+
+    async def delete_user(self, token, username):
+        status, _ = await self._send("DELETE", f"/api/user/{username}", token)
+        logger.info("Ответ на удаление %s: %s", username, status)
+        if status in (200, 204):
+            logger.info("Пользователь %s успешно удалён из Marzban", username)
+            return True
+        elif status == 404:
+            logger.info("Пользователь %s не найден в Marzban, пропускаем удаление", username)
+            return True
+        logger.error(f"Ошибка удаления пользователя {username}: {status}")
+        return False
+
+    async def set_user_status(self, token, username, user_status):
+        status, _ = await self._send("PUT", f"/api/user/{username}", token, json={"status": user_status})
+        logger.info("Ответ на смену статуса %s на %s: %s", username, user_status, status)
+        if status == 200:
+            logger.info("Ключ %s успешно переведён в статус %s", username, user_status)
+            return True
+        logger.error(f"Ошибка смены статуса ключа {username} на {user_status}: {status}")
+        return False
+
+
+class InboundRegistry:
+    # Кэш топологии inbound'ов: обновляется в фоне по TTL и сбрасывается при ошибке создания
+    def __init__(self, client, ttl=300):
+        self._client = client
+        self._ttl = ttl
+        self._topology = None
+        self._fetched_at = 0.0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def invalidate(self):
+        logger.info("Кэш inbound'ов сброшен")
+        self._fetched_at = 0.0
+
+    def _is_fresh(self):
+        return self._topology is not None and time.monotonic() - self._fetched_at < self._ttl
+
+    async def refresh(self, token) -> Optional[InboundTopology]:
+        data = await self._client.get_inbounds(token)
+        if data is None:
+            # Оставляем прежнюю топологию, если Marzban временно недоступен
+            return self._topology
+        topology = InboundTopology.from_payload(data)
+        if self._topology is None or topology.fingerprint != self._topology.fingerprint:
+            logger.info("Топология inbound'ов изменилась: %s", topology.fingerprint)
+        self._topology = topology
+        self._fetched_at = time.monotonic()
+        return topology
+
+    async def get(self, token) -> Optional[InboundTopology]:
+        if self._is_fresh():
+            return self._topology
+        async with self._lock:
+            if self._is_fresh():
+                return self._topology
+            return await self.refresh(token)
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                token = await get_marzban_token()
+                if token:
+                    async with self._lock:
+                        await self.refresh(token)
+            except Exception as e:
+                logger.error(f"Ошибка фонового обновления inbound'ов: {e}")
+            await asyncio.sleep(self._ttl)
 
-async def create_vpn_user(token, username, inbounds):
-    if not inbounds or "vless" not in inbounds or not inbounds["vless"]:
-        logger.error(f"Нет доступных vless inbound'ов для создания пользователя {username}")
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+def _token_expiry(token):
+    # Срок жизни из поля exp JWT (секунды UTC); подпись не проверяем — токен выдан нашим же Marzban
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        return float(exp) if exp is not None else None
+    except (IndexError, ValueError, TypeError, AttributeError):
         return None
-    inbound_tag = inbounds["vless"][0]["tag"]
-    inbound = {"vless": [inbound_tag]}
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            f"{MARZBAN_URL}/api/user",
-            headers={"Authorization": f"Bearer {token}"},
-            json={"username": username, "proxies": {"vless": {}}, "inbounds": inbound},
-            ssl=False
-        ) as response:
-            if response.status == 200:
-                return await response.json()
-            logger.error(f"Ошибка создания пользователя {username}: {response.status} - {await response.text()}")
+
+
+class TokenManager:
+    # Токен администратора Marzban: обновляется в фоне до истечения срока; одновременно идёт
+    # не больше одного логина, его результат (в том числе неудачу) получают все ожидающие
+    def __init__(self, client, refresh_margin=300, fallback_ttl=3600, retry_interval=10, failure_backoff=2):
+        self._client = client
+        self._refresh_margin = refresh_margin
+        self._fallback_ttl = fallback_ttl
+        self._retry_interval = retry_interval
+        self._failure_backoff = failure_backoff
+        self._token = None
+        self._valid_until = 0.0
+        self._refresh_at = 0.0
+        self._failed_until = 0.0
+        self._inflight = None
+        self._task = None
+
+    def _is_valid(self):
+        return self._token is not None and time.monotonic() < self._valid_until
+
+    async def _login(self):
+        try:
+            token = await self._client.get_token()
+        except Exception:
+            self._failed_until = time.monotonic() + self._failure_backoff
+            raise
+        if not token:
+            # После неудачи короткое время не пробуем снова, чтобы не устроить шторм логинов
+            self._failed_until = time.monotonic() + self._failure_backoff
             return None
+        exp = _token_expiry(token)
+        ttl = exp - time.time() if exp is not None else self._fallback_ttl
+        if ttl < 30:
+            # Свежий токен уже истёк или вот-вот истечёт по нашим часам — часы сервера и бота расходятся.
+            # Без нижней границы токен сразу считался бы протухшим, и каждый запрос шёл бы на логин
+            logger.warning("Токен Marzban истекает через %.0fс, возможно расхождение часов с сервером", ttl)
+            ttl = 30
+        self._token = token
+        now = time.monotonic()
+        # Запас на расхождение часов и время в пути запроса, но не больше десятой части срока
+        self._valid_until = now + ttl - min(30, ttl / 10)
+        # Короткоживущий токен обновляем на середине срока, чтобы не уйти в цикл логинов
+        self._refresh_at = now + max(ttl - self._refresh_margin, ttl / 2)
+        logger.info("Получен токен Marzban, действует %.0fс", ttl)
+        return token
+
+    async def _shared_login(self):
+        # Все одновременные вызовы ждут одну задачу логина; shield не даёт отмене одного
+        # ожидающего прервать логин для остальных
+        if self._inflight is None:
+            self._inflight = asyncio.create_task(self._login())
+            self._inflight.add_done_callback(self._clear_inflight)
+        return await asyncio.shield(self._inflight)
+
+    def _clear_inflight(self, task):
+        if self._inflight is task:
+            self._inflight = None
+        if not task.cancelled():
+            # Исключение уже получили ожидающие; здесь только помечаем его полученным
+            task.exception()
+
+    async def get(self):
+        if self._is_valid():
+            return self._token
+        return await self.refresh()
+
+    async def refresh(self, stale=None):
+        # stale — токен, который отверг Marzban; если его уже заменили, повторный логин не нужен
+        if self._is_valid() and (stale is None or self._token != stale):
+            return self._token
+        if stale is not None and self._token == stale:
+            self._token = None
+        if self._inflight is None and time.monotonic() < self._failed_until:
+            return None
+        return await self._shared_login()
+
+    async def _refresh_loop(self):
+        while True:
+            delay = self._refresh_at - time.monotonic()
+            if self._token is not None and delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                token = await self._shared_login()
+            except Exception as e:
+                logger.error(f"Ошибка фонового обновления токена Marzban: {e}")
+                token = None
+            if not token:
+                await asyncio.sleep(self._retry_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+_client = None
+_inbound_registry = None
+_token_manager = None
+
+
+def get_marzban_client():
+    global _client
+    if _client is None:
+        _client = MarzbanClient(
+            MARZBAN_URL,
+            limit=MARZBAN_POOL_LIMIT,
+            limit_per_host=MARZBAN_POOL_LIMIT_PER_HOST,
+            timeout=MARZBAN_TIMEOUT
+        )
+    return _client
+
+
+def get_inbound_registry():
+    global _inbound_registry
+    if _inbound_registry is None:
+        _inbound_registry = InboundRegistry(get_marzban_client(), ttl=MARZBAN_INBOUNDS_TTL)
+    return _inbound_registry
+
+
+def get_token_manager():
+    global _token_manager
+    if _token_manager is None:
+        _token_manager = TokenManager(
+            get_marzban_client(),
+            refresh_margin=MARZBAN_TOKEN_REFRESH_MARGIN,
+            fallback_ttl=MARZBAN_TOKEN_FALLBACK_TTL
+        )
+    return _token_manager
+
+
+async def close_marzban_client():
+    global _client, _inbound_registry, _token_manager
+    if _token_manager is not None:
+        await _token_manager.stop()
+        _token_manager = None
+    if _inbound_registry is not None:
+        await _inbound_registry.stop()
+        _inbound_registry = None
+    if _client is not None:
+        await _client.close()
+        _client = None
+
+
+async def get_marzban_token():
+    return await get_token_manager().get()
+
+async def get_available_inbounds(token) -> Optional[InboundTopology]:
+    return await get_inbound_registry().get(token)
+
+async def get_vpn_user(token, username):
+    return await get_marzban_client().get_user(token, username)
+
+def iter_vpn_users(token, page_size=MARZBAN_PAGE_SIZE):
+    return get_marzban_client().iter_users(token, page_size)
+
+async def create_vpn_user(token, username, inbounds: InboundTopology):
+    return await get_marzban_client().create_user(token, username, inbounds)
 
 async def delete_vpn_user(token, username):
-    async with aiohttp.ClientSession() as session:
-        async with session.delete(
-            f"{MARZBAN_URL}/api/user/{username}",
-            headers={"Authorization": f"Bearer {token}"},
-            ssl=False
-        ) as response:
-            logger.info(f"Ответ на удаление {username}: {response.status}")
-            if response.status in (200, 204):
-                logger.info(f"Пользователь {username} успешно удалён из Marzban")
-                return True
-            elif response.status == 404:
-                logger.info(f"Пользователь {username} не найден в Marzban, пропускаем удаление")
-                return True
-            logger.error(f"Ошибка удаления пользователя {username}: {response.status}")
-            return False
+    return await get_marzban_client().delete_user(token, username)
 
 async def disable_vpn_user(token, username):
-    async with aiohttp.ClientSession() as session:
-        async with session.put(
-            f"{MARZBAN_URL}/api/user/{username}",
-            headers={"Authorization": f"Bearer {token}"},
-            json={"status": "disabled"},
-            ssl=False
-        ) as response:
-            logger.info(f"Ответ на отключение {username}: {response.status}")
-            if response.status == 200:
-                logger.info(f"Ключ {username} успешно отключён")
-                return True
-            logger.error(f"Ошибка отключения ключа {username}: {response.status}")
-            return False
+    return await get_marzban_client().set_user_status(token, username, "disabled")
 
 async def enable_vpn_user(token, username):
-    async with aiohttp.ClientSession() as session:
-        async with session.put(
-            f"{MARZBAN_URL}/api/user/{username}",
-            headers={"Authorization": f"Bearer {token}"},
-            json={"status": "active"},
-            ssl=False
-        ) as response:
-            if response.status == 200:
-                logger.info(f"Ключ {username} успешно включён")
-                return True
-            logger.error(f"Ошибка включения ключа {username}: {response.status}")
-            return False
\ No newline at end of file
+    return await get_marzban_client().set_user_status(token, username, "active")
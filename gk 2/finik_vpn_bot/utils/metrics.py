@@ -0,0 +1,88 @@
+from aiogram import BaseMiddleware
+from aiohttp import web
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+import re
+import time
+
+# Метрики процесса в формате Prometheus. Процессы не разделяют состояние, поэтому
+# при WEB_PROCESSES > 1 каждый рабочий процесс отдаёт свои метрики на METRICS_PORT + индекс
+
+HANDLER_LATENCY = Histogram(
+    "bot_handler_latency_seconds", "Время выполнения handler'а aiogram", ["handler"]
+)
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Исключения в handler'ах aiogram", ["handler"]
+)
+
+EXTERNAL_LATENCY = Histogram(
+    "bot_external_request_latency_seconds", "Время запроса к внешнему API", ["service", "endpoint"]
+)
+EXTERNAL_ERRORS = Counter(
+    "bot_external_request_errors_total", "Ошибки запросов к внешнему API", ["service", "endpoint", "reason"]
+)
+
+DB_POOL_SIZE = Gauge("bot_db_pool_size", "Открытых соединений в пуле asyncpg")
+DB_POOL_IN_USE = Gauge("bot_db_pool_in_use", "Занятых соединений в пуле asyncpg")
+DB_POOL_MAX = Gauge("bot_db_pool_max_size", "Максимальный размер пула asyncpg")
+DB_POOL_WAIT = Histogram(
+    "bot_db_pool_wait_seconds", "Ожидание свободного соединения из пула asyncpg",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+)
+
+SWEEP_DURATION = Histogram(
+    "bot_sweep_duration_seconds", "Длительность прохода по подпискам", ["mode"],
+    buckets=(0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800)
+)
+SWEEP_USERS = Gauge("bot_sweep_last_run_users", "Пользователей в последнем проходе по подпискам", ["mode"])
+SWEEP_USERS_TOTAL = Counter("bot_sweep_users_total", "Обработано пользователей проходами по подпискам", ["mode"])
+
+WEBHOOK_QUEUE_DEPTH = Gauge("bot_webhook_queue_depth", "Апдейтов Telegram в очереди на обработку")
+
+_USERNAME_PATH = re.compile(r"^(/api/user)/[^/]+")
+_USERNAME_REPLACEMENT = r"\1/{username}"
+
+
+def marzban_endpoint(method, path):
+    # Имя пользователя в пути схлопываем, иначе каждый пользователь станет отдельной серией
+    return f"{method} {_USERNAME_PATH.sub(_USERNAME_REPLACEMENT, path)}"
+
+
+def observe_external(service, endpoint, started, error=None):
+    EXTERNAL_LATENCY.labels(service, endpoint).observe(time.perf_counter() - started)
+    if error is not None:
+        EXTERNAL_ERRORS.labels(service, endpoint, error).inc()
+
+
+def observe_sweep(mode, started, users):
+    SWEEP_DURATION.labels(mode).observe(time.perf_counter() - started)
+    SWEEP_USERS.labels(mode).set(users)
+    SWEEP_USERS_TOTAL.labels(mode).inc(users)
+
+
+def track_db_pool(pool):
+    DB_POOL_SIZE.set_function(pool.get_size)
+    DB_POOL_IN_USE.set_function(lambda: pool.get_size() - pool.get_idle_size())
+    DB_POOL_MAX.set_function(pool.get_max_size)
+
+
+def track_queue_depth(queue):
+    WEBHOOK_QUEUE_DEPTH.set_function(queue.qsize)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Внутренний middleware: вызывается после фильтров, когда уже известен выбранный handler
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            HANDLER_LATENCY.labels(name).observe(time.perf_counter() - started)
+
+
+async def metrics_handler(request):
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
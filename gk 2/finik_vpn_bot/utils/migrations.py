@@ -0,0 +1,261 @@
+import asyncio
+import asyncpg
+import logging
+import re
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-lock, чтобы миграции не применялись параллельно из нескольких процессов
+MIGRATIONS_LOCK_ID = 7_340_001
+# Пауза между попытками взять блокировку миграций, секунды
+MIGRATIONS_LOCK_POLL = 0.5
+
+_CONCURRENT_INDEX = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.I)
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    statements: tuple
+    # CREATE INDEX CONCURRENTLY нельзя выполнять в транзакции
+    transactional: bool = True
+
+
+class Backfill(NamedTuple):
+    # UPDATE одной пачки строк: повторяется, пока что-то обновляет, каждая пачка коммитится отдельно,
+    # чтобы не держать блокировку таблицы на всё заполнение. Только в нетранзакционных миграциях
+    statement: str
+
+
+MIGRATIONS = (
+    Migration(1, "baseline", (
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            subscription_end TIMESTAMP,
+            invited INTEGER DEFAULT 0,
+            referral_link TEXT,
+            vpn_key TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS invited_users (
+            referrer_id BIGINT,
+            invited_user_id BIGINT,
+            PRIMARY KEY (referrer_id, invited_user_id),
+            FOREIGN KEY (referrer_id) REFERENCES users(user_id),
+            FOREIGN KEY (invited_user_id) REFERENCES users(user_id),
+            bonus_activated BOOLEAN DEFAULT FALSE
+        )
+        ''',
+    )),
+    Migration(2, "payments", (
+        '''
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id TEXT PRIMARY KEY,
+            order_id TEXT,
+            user_id BIGINT NOT NULL,
+            days INTEGER NOT NULL,
+            amount NUMERIC(12, 2),
+            state TEXT NOT NULL DEFAULT 'processing',
+            created_at TIMESTAMP NOT NULL DEFAULT now(),
+            updated_at TIMESTAMP
+        )
+        ''',
+    )),
+    # Добавление колонки с неизменчивым DEFAULT в PostgreSQL 11+ не переписывает таблицу
+    Migration(3, "created_at_columns", (
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT now()",
+        "ALTER TABLE invited_users ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT now()",
+    )),
+    Migration(4, "hot_query_indexes", (
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS users_subscription_end_idx "
+        "ON users (subscription_end)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS invited_users_pending_bonus_idx "
+        "ON invited_users (invited_user_id) WHERE bonus_activated = FALSE",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS payments_user_id_idx "
+        "ON payments (user_id)",
+    ), transactional=False),
+    Migration(5, "broadcast_jobs", (
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked BOOLEAN NOT NULL DEFAULT FALSE",
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            broadcast_id BIGSERIAL PRIMARY KEY,
+            text TEXT NOT NULL,
+            created_by BIGINT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'running',
+            created_at TIMESTAMP NOT NULL DEFAULT now(),
+            finished_at TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id BIGINT NOT NULL REFERENCES broadcasts(broadcast_id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            updated_at TIMESTAMP,
+            PRIMARY KEY (broadcast_id, user_id)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS broadcast_deliveries_pending_idx "
+        "ON broadcast_deliveries (broadcast_id, user_id) WHERE state = 'pending'",
+    )),
+    Migration(6, "menu_messages", (
+        '''
+        CREATE TABLE IF NOT EXISTS menu_messages (
+            user_id BIGINT PRIMARY KEY,
+            subscription_msg_id BIGINT,
+            payment_msg_id BIGINT,
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        )
+        ''',
+    )),
+    # Все пользователи с подпиской однократно попадают в очередь, дальше время ведёт планировщик.
+    # Колонка без значения по умолчанию добавляется мгновенно, а заполнение идёт пачками
+    Migration(7, "next_action_at", (
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS next_action_at TIMESTAMP",
+        Backfill(
+            "UPDATE users SET next_action_at = LOCALTIMESTAMP WHERE user_id IN ("
+            "SELECT user_id FROM users WHERE subscription_end IS NOT NULL AND next_action_at IS NULL LIMIT 5000)"
+        ),
+    ), transactional=False),
+    Migration(8, "next_action_at_index", (
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS users_next_action_at_idx "
+        "ON users (next_action_at) WHERE next_action_at IS NOT NULL",
+    ), transactional=False),
+    Migration(9, "marzban_state", (
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS marzban_status TEXT",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS marzban_synced_at TIMESTAMP",
+    )),
+    Migration(10, "reminders_outbox", (
+        '''
+        CREATE TABLE IF NOT EXISTS reminders (
+            user_id BIGINT NOT NULL,
+            kind TEXT NOT NULL,
+            subscription_end TIMESTAMP NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            created_at TIMESTAMP NOT NULL DEFAULT now(),
+            sent_at TIMESTAMP,
+            PRIMARY KEY (user_id, kind, subscription_end)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS reminders_pending_idx ON reminders (created_at) WHERE state = 'pending'",
+    )),
+    # Неоплаченный платёж на пару (пользователь, тариф): повторное нажатие получает ту же ссылку
+    Migration(11, "pending_payments", (
+        '''
+        CREATE TABLE IF NOT EXISTS pending_payments (
+            user_id BIGINT NOT NULL,
+            plan_id TEXT NOT NULL,
+            payment_id TEXT NOT NULL UNIQUE,
+            order_id TEXT NOT NULL,
+            confirmation_url TEXT NOT NULL,
+            expires_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (user_id, plan_id)
+        )
+        ''',
+    )),
+    # Счётчик invited мог разойтись со связями (сбой между вставкой и UPDATE); выравниваем один раз,
+    # дальше его ведёт тот же запрос, что вставляет связь
+    Migration(12, "resync_invited_counters", (
+        "UPDATE users AS u SET invited = c.invited "
+        "FROM (SELECT u2.user_id, COUNT(i.invited_user_id) AS invited FROM users AS u2 "
+        "LEFT JOIN invited_users AS i ON i.referrer_id = u2.user_id GROUP BY u2.user_id) AS c "
+        "WHERE u.user_id = c.user_id AND u.invited IS DISTINCT FROM c.invited",
+    )),
+)
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+async def get_schema_version(conn):
+    try:
+        return await conn.fetchval("SELECT max(version) FROM schema_migrations") or 0
+    except asyncpg.UndefinedTableError:
+        return 0
+
+
+async def _apply(conn, migration):
+    if migration.transactional:
+        async with conn.transaction():
+            for statement in migration.statements:
+                await conn.execute(statement)
+            await conn.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+                migration.version, migration.name
+            )
+        return
+    for statement in migration.statements:
+        if isinstance(statement, Backfill):
+            await _backfill(conn, statement.statement)
+            continue
+        await _drop_invalid_index(conn, statement)
+        await conn.execute(statement)
+    await conn.execute(
+        "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+        migration.version, migration.name
+    )
+
+
+async def _backfill(conn, statement):
+    total = 0
+    while True:
+        # Вне транзакции каждый execute коммитится сам
+        status = await conn.execute(statement)
+        updated = int(status.split()[-1])
+        if not updated:
+            break
+        total += updated
+    logger.info(f"Заполнено строк: {total}")
+
+
+async def _drop_invalid_index(conn, statement):
+    # Прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс, который IF NOT EXISTS
+    # молча пропустит; такой индекс удаляем, чтобы он построился заново
+    match = _CONCURRENT_INDEX.search(statement)
+    if not match:
+        return
+    name = match.group(1)
+    valid = await conn.fetchval(
+        "SELECT i.indisvalid FROM pg_index AS i JOIN pg_class AS c ON c.oid = i.indexrelid "
+        "WHERE c.relname = $1 AND pg_catalog.pg_table_is_visible(c.oid)",
+        name
+    )
+    if valid is False:
+        logger.warning(f"Индекс {name} невалиден после прерванного построения, пересоздаём")
+        await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+async def _lock(conn):
+    # Ждём блокировку опросом, а не в pg_advisory_lock: ожидающий процесс держал бы открытый снимок,
+    # и CREATE INDEX CONCURRENTLY у владельца блокировки ждал бы его — взаимная блокировка
+    while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATIONS_LOCK_ID):
+        await asyncio.sleep(MIGRATIONS_LOCK_POLL)
+
+
+async def run_migrations(conn):
+    # Быстрая проверка: схема актуальна — никакого DDL на старте
+    if await get_schema_version(conn) >= LATEST_VERSION:
+        logger.info(f"Схема БД актуальна, версия {LATEST_VERSION}")
+        return
+
+    await _lock(conn)
+    try:
+        await conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT now()
+            )
+        ''')
+        # Версию перечитываем под блокировкой: другой процесс мог успеть применить миграции
+        current = await get_schema_version(conn)
+        for migration in MIGRATIONS:
+            if migration.version <= current:
+                continue
+            logger.info(f"Применяем миграцию {migration.version}: {migration.name}")
+            await _apply(conn, migration)
+        logger.info(f"Схема БД обновлена до версии {LATEST_VERSION}")
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
@@ -0,0 +1,65 @@
+from utils.db import save_vpn_key, record_marzban_states, transaction
+from utils.marzban import get_marzban_token, get_available_inbounds, get_vpn_user, create_vpn_user, enable_vpn_user, \
+    MarzbanError
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Выдача ключа в работе: user_id -> asyncio.Task; параллельные запросы ждут одну и ту же задачу
+_inflight = {}
+
+
+async def _provision(user_id, token=None):
+    username = f"user_{user_id}"
+    if token is None:
+        token = await get_marzban_token()
+        if not token:
+            logger.error(f"Не удалось получить токен Marzban для выдачи ключа user_id={user_id}")
+            return None
+
+    # _inflight объединяет вызовы внутри процесса; между процессами дубликат не возникнет:
+    # повторный POST вернёт 409, и create_vpn_user отдаст уже созданного пользователя.
+    # Транзакцию на время запросов к Marzban не держим — ключ сохраняется коротко в конце
+    try:
+        user_data = await get_vpn_user(token, username)
+        if not user_data or not user_data.get("subscription_url"):
+            inbounds = await get_available_inbounds(token)
+            if not inbounds:
+                logger.error(f"Не удалось получить inbounds для user_id={user_id}")
+                return None
+            user_data = await create_vpn_user(token, username, inbounds)
+            if not user_data or not user_data.get("subscription_url"):
+                logger.error(f"Не удалось создать пользователя {username} в Marzban")
+                return None
+            logger.info("Ключ %s выдан", username)
+        else:
+            # Пользователь уже есть в Marzban (например, ключ потерян в БД) — переиспользуем его,
+            # вместо удаления и повторного создания
+            logger.info("Ключ %s найден в Marzban, переиспользуем", username)
+    except MarzbanError as e:
+        # Не знаем, есть ли пользователь в Marzban, — создавать второго нельзя
+        logger.error(f"Не удалось проверить ключ user_id={user_id}: {e}")
+        return None
+
+    if user_data.get("status") != "active":
+        if not await enable_vpn_user(token, username):
+            return None
+        user_data["status"] = "active"
+
+    async with transaction() as conn:
+        await save_vpn_key(user_id, user_data["subscription_url"], conn=conn)
+        await record_marzban_states([(user_id, "active")], conn=conn)
+    return user_data
+
+
+async def provision_vpn_key(user_id, token=None):
+    # Единственный путь создания ключа: одновременные вызовы для одного пользователя
+    # сливаются в одну операцию, результат (данные пользователя Marzban или None) получают все
+    task = _inflight.get(user_id)
+    if task is None:
+        task = asyncio.create_task(_provision(user_id, token))
+        _inflight[user_id] = task
+        task.add_done_callback(lambda _: _inflight.pop(user_id, None))
+    # shield: отмена одного ожидающего (например, по таймауту прохода) не прерывает выдачу для остальных
+    return await asyncio.shield(task)
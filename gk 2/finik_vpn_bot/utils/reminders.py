@@ -0,0 +1,151 @@
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
+from config import REMINDER_DAYS, REMINDER_RATE
+from utils.broadcast import AdaptiveRateLimiter
+from utils.db import init_db_pool
+from datetime import datetime
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+REMINDER_BATCH_SIZE = 100
+REMINDER_POLL_INTERVAL = 30
+
+_sender_task = None
+_wakeup = None
+
+
+def _days_word(days):
+    if days % 10 == 1 and days % 100 != 11:
+        return "день"
+    if days % 10 in (2, 3, 4) and days % 100 not in (12, 13, 14):
+        return "дня"
+    return "дней"
+
+
+def reminder_kind(days_left):
+    # Напоминание ближайшего порога, который уже наступил; пропущенный порог не теряется
+    for days in sorted(REMINDER_DAYS):
+        if 0 < days_left <= days:
+            return f"expiry_{days}d"
+    return None
+
+
+def reminder_text(days_left):
+    return (
+        f"⚠️ Ваша подписка истекает через {days_left} {_days_word(days_left)}! "
+        f"Продлите доступ в меню 'Купить'."
+    )
+
+
+async def enqueue_reminders(reminders):
+    # reminders: список (user_id, kind, subscription_end); ключ outbox отбрасывает повторы за тот же период
+    if not reminders:
+        return
+    pool = await init_db_pool()
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "INSERT INTO reminders (user_id, kind, subscription_end) "
+            "SELECT * FROM unnest($1::bigint[], $2::text[], $3::timestamp[]) "
+            "ON CONFLICT DO NOTHING",
+            [user_id for user_id, _, _ in reminders],
+            [kind for _, kind, _ in reminders],
+            [sub_end for _, _, sub_end in reminders]
+        )
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+async def _claim(conn):
+    # Забираем пачку и сразу помечаем её отправляемой: повторно она не уйдёт даже после рестарта
+    return await conn.fetch(
+        "UPDATE reminders AS r SET state = 'sending' "
+        "FROM users AS u "
+        "WHERE u.user_id = r.user_id AND (r.user_id, r.kind, r.subscription_end) IN ("
+        "SELECT user_id, kind, subscription_end FROM reminders WHERE state = 'pending' "
+        "ORDER BY created_at LIMIT $1 FOR UPDATE SKIP LOCKED"
+        ") "
+        "RETURNING r.user_id, r.kind, r.subscription_end, u.subscription_end AS current_end",
+        REMINDER_BATCH_SIZE
+    )
+
+
+async def _send(bot: Bot, limiter, reminder):
+    # Подписку уже продлили — напоминание о старой дате не нужно
+    if reminder["current_end"] != reminder["subscription_end"]:
+        return "stale"
+    days_left = (reminder["subscription_end"] - datetime.now()).days
+    if days_left <= 0:
+        return "stale"
+    while True:
+        await limiter.acquire()
+        try:
+            await bot.send_message(reminder["user_id"], reminder_text(days_left))
+            limiter.on_success()
+            return "sent"
+        except TelegramRetryAfter as e:
+            limiter.on_retry_after(e.retry_after)
+        except TelegramForbiddenError:
+            return "blocked"
+        except Exception as e:
+            logger.error(f"Ошибка отправки напоминания user_id={reminder['user_id']}: {e}")
+            return "failed"
+
+
+async def drain_reminders(bot: Bot, limiter):
+    pool = await init_db_pool()
+    sent = 0
+    while True:
+        async with pool.acquire() as conn:
+            batch = await _claim(conn)
+        if not batch:
+            return sent
+        states = [await _send(bot, limiter, reminder) for reminder in batch]
+        async with pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE reminders AS r SET state = v.state, "
+                "sent_at = CASE WHEN v.state = 'sent' THEN now() END "
+                "FROM unnest($1::bigint[], $2::text[], $3::timestamp[], $4::text[]) "
+                "AS v(user_id, kind, subscription_end, state) "
+                "WHERE r.user_id = v.user_id AND r.kind = v.kind AND r.subscription_end = v.subscription_end",
+                [r["user_id"] for r in batch],
+                [r["kind"] for r in batch],
+                [r["subscription_end"] for r in batch],
+                states
+            )
+            blocked = [r["user_id"] for r, state in zip(batch, states) if state == "blocked"]
+            if blocked:
+                await conn.execute("UPDATE users SET blocked = TRUE WHERE user_id = ANY($1::bigint[])", blocked)
+        sent += states.count("sent")
+
+
+async def _sender_loop(bot: Bot):
+    limiter = AdaptiveRateLimiter(REMINDER_RATE)
+    while True:
+        _wakeup.clear()
+        try:
+            sent = await drain_reminders(bot, limiter)
+            if sent:
+                logger.info(f"Отправлено напоминаний: {sent}")
+        except Exception as e:
+            logger.error(f"Ошибка отправки напоминаний: {e}")
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=REMINDER_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_reminder_sender(bot: Bot):
+    global _sender_task, _wakeup
+    if _sender_task is None:
+        _wakeup = asyncio.Event()
+        _sender_task = asyncio.create_task(_sender_loop(bot))
+
+
+async def stop_reminder_sender():
+    global _sender_task
+    if _sender_task is not None:
+        _sender_task.cancel()
+        await asyncio.gather(_sender_task, return_exceptions=True)
+        _sender_task = None
@@ -0,0 +1,56 @@
+from config import JSON_CODEC, EVENT_LOOP
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Необязательные ускорители: без них бот работает на стандартных json и asyncio
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+def _pick(setting, name, module):
+    if setting == "auto":
+        return module is not None
+    if setting == name:
+        if module is None:
+            logger.warning(f"{name} не установлен, используем стандартную реализацию")
+        return module is not None
+    return False
+
+
+if _pick(JSON_CODEC, "orjson", orjson):
+    JSON_CODEC_NAME = "orjson"
+
+    def json_loads(data):
+        return orjson.loads(data)
+
+    def json_dumps(obj):
+        # aiohttp и aiogram ждут от сериализатора строку
+        return orjson.dumps(obj).decode()
+else:
+    JSON_CODEC_NAME = "json"
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+
+def loop_factory():
+    # None — обычный event loop asyncio
+    if _pick(EVENT_LOOP, "uvloop", uvloop):
+        return uvloop.new_event_loop
+    return None
+
+
+def run(coro):
+    factory = loop_factory()
+    with asyncio.Runner(loop_factory=factory) as runner:
+        logger.info("Event loop: %s, JSON: %s", "uvloop" if factory else "asyncio", JSON_CODEC_NAME)
+        return runner.run(coro)
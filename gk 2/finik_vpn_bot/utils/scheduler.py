@@ -1,82 +1,312 @@
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from datetime import datetime, timedelta
-from utils.db import get_user_status, save_vpn_key, init_db_pool
-from utils.marzban import disable_vpn_user, enable_vpn_user, get_marzban_token, create_vpn_user, get_available_inbounds, delete_vpn_user, get_vpn_user
-from aiogram import Bot
-from config import TELEGRAM_BOT_TOKEN
+from utils.db import get_user_status, save_vpn_key, save_vpn_keys, get_subscribed_users, iter_users, \
+    claim_due_users, set_next_action, get_next_due_at, record_marzban_states
+from utils.marzban import disable_vpn_user, enable_vpn_user, get_marzban_token, delete_vpn_user, get_vpn_user, \
+    iter_vpn_users, MarzbanError
+from utils.provisioning import provision_vpn_key
+from utils.reminders import reminder_kind, enqueue_reminders
+from utils.sweep import run_pool
+from utils.metrics import observe_sweep
+from config import SWEEP_MODE, SWEEP_BATCH_SIZE, SWEEP_LEASE_MINUTES, SWEEP_MAX_SLEEP, SWEEP_CONCURRENCY, SWEEP_USER_TIMEOUT, \
+    RECONCILE_INTERVAL_MINUTES, REMINDER_DAYS, MARZBAN_VERIFY_HOURS
 import asyncio
 import logging
+import time
 
 scheduler = AsyncIOScheduler()
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
 logger = logging.getLogger(__name__)
 
-async def process_user(user, token):
+# Маркер результата process_user: обработать пользователя повторно после истечения аренды
+RETRY = object()
+_due_task = None
+
+def _parse_marzban_time(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).replace(tzinfo=None)
+
+def plan_reconcile(db_users, marzban_users, now):
+    # Сверяет строки users с выгрузкой Marzban и возвращает только нужные действия
+    actions = {"create": [], "enable": [], "disable": [], "delete": [], "save_keys": [], "remind": [], "record": []}
+    for user in db_users:
+        user_id = user["user_id"]
+        username = f"user_{user_id}"
+        sub_end = user["subscription_end"]
+        active = sub_end > now
+        marzban_user = marzban_users.get(username)
+
+        if marzban_user and not active:
+            last_active = marzban_user.get("online_at") or marzban_user.get("created_at")
+            if last_active and (now - _parse_marzban_time(last_active)).days >= 15:
+                actions["delete"].append(user_id)
+                if user["vpn_key"]:
+                    actions["save_keys"].append((user_id, None))
+                continue
+
+        # Напоминание не зависит от состояния в Marzban, поэтому считается до ранних continue
+        kind = reminder_kind((sub_end - now).days) if active else None
+        if kind:
+            actions["remind"].append((user_id, kind, sub_end))
+
+        if not marzban_user:
+            if active:
+                actions["create"].append(user_id)
+            elif user["vpn_key"]:
+                actions["save_keys"].append((user_id, None))
+            continue
+
+        if not user["vpn_key"] and marzban_user.get("subscription_url"):
+            actions["save_keys"].append((user_id, marzban_user["subscription_url"]))
+
+        observed = marzban_user.get("status")
+        if active and observed != "active":
+            actions["enable"].append(user_id)
+        elif not active and observed == "active":
+            actions["disable"].append(user_id)
+        elif observed != user["marzban_status"]:
+            # Менять в Marzban нечего, но записанное у нас состояние устарело
+            actions["record"].append((user_id, observed))
+    return actions
+
+async def reconcile_subscriptions(token, concurrency=20):
+    now = datetime.now()
+    db_users = await get_subscribed_users()
+    marzban_users = {}
+    try:
+        async for marzban_user in iter_vpn_users(token):
+            marzban_users[marzban_user["username"]] = marzban_user
+    except MarzbanError as e:
+        logger.error(f"Сверка прервана, выгрузка Marzban неполная: {e}")
+        return 0
+
+    actions = plan_reconcile(db_users, marzban_users, now)
+    logger.info(
+        f"Сверка: пользователей в БД={len(db_users)}, в Marzban={len(marzban_users)}, "
+        + ", ".join(f"{kind}={len(items)}" for kind, items in actions.items())
+    )
+
+    save_keys = list(actions["save_keys"])
+    marzban_states = list(actions["record"])
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(kind, user_id):
+        username = f"user_{user_id}"
+        async with semaphore:
+            if kind == "create":
+                # Ключ и состояние сохраняет сам сервис выдачи
+                await provision_vpn_key(user_id, token)
+            elif kind == "enable":
+                if await enable_vpn_user(token, username):
+                    marzban_states.append((user_id, "active"))
+            elif kind == "disable":
+                if await disable_vpn_user(token, username):
+                    marzban_states.append((user_id, "disabled"))
+            elif kind == "delete":
+                logger.info("Пользователь %s неактивен более 15 дней, удаляем ключ", username)
+                if await delete_vpn_user(token, username):
+                    marzban_states.append((user_id, None))
+
+    tasks = [run(kind, user_id) for kind in ("create", "enable", "disable", "delete")
+             for user_id in actions[kind]]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка при выполнении действия сверки: {result}")
+
+    await save_vpn_keys(save_keys)
+    await record_marzban_states(marzban_states)
+    await enqueue_reminders(actions["remind"])
+    return len(db_users)
+
+def next_action_time(sub_end, now, last_active=None):
+    # Ближайший момент, когда пользователю снова понадобится внимание планировщика
+    if sub_end and sub_end > now:
+        candidates = [sub_end]
+        for days in REMINDER_DAYS:
+            # Порог days наступает, когда до конца подписки остаётся меньше days + 1 дней
+            reminder_at = sub_end - timedelta(days=days + 1) + timedelta(seconds=1)
+            if reminder_at > now:
+                candidates.append(reminder_at)
+        return min(candidates)
+    if last_active is not None:
+        # Ключ истёкшего пользователя удаляется после 15 дней неактивности
+        return max(last_active + timedelta(days=15), now + timedelta(minutes=1))
+    return None
+
+async def sync_marzban_status(token, user, username, desired, user_data, now):
+    # user_data — только что полученный из Marzban пользователь, поэтому сравниваем с фактическим
+    # статусом: ключ, отключённый админом или лимитами Marzban, исправляется в этом же проходе.
+    # Записанное у нас состояние обновляем только при расхождении или раз в MARZBAN_VERIFY_HOURS.
+    # False — Marzban не принял изменение, пользователя нужно обработать повторно
+    if user_data.get("status") != desired:
+        if desired == "active":
+            pushed = await enable_vpn_user(token, username)
+        else:
+            pushed = await disable_vpn_user(token, username)
+        if not pushed:
+            return False
+        await record_marzban_states([(user["user_id"], desired)])
+        return True
+    synced_at = user.get("marzban_synced_at")
+    verify_due = synced_at is None or now - synced_at >= timedelta(hours=MARZBAN_VERIFY_HOURS)
+    if user.get("marzban_status") != desired or verify_due:
+        await record_marzban_states([(user["user_id"], desired)])
+    return True
+
+async def process_user(user, token, status=None):
+    # Возвращает время следующего действия или RETRY, если обработку нужно повторить позже
     user_id = user["user_id"]
-    status = await get_user_status(user_id)
+    if status is None:
+        status = await get_user_status(user_id)
     username = f"user_{user_id}"
 
     current_time = datetime.now()
-    logger.info(f"Проверка user_id={user_id}: active={status['active']}, days_left={status['days_left']}")
+    logger.info("Проверка user_id=%s: active=%s, days_left=%s", user_id, status['active'], status['days_left'])
 
-    user_data = await get_vpn_user(token, username)
-    inbounds = await get_available_inbounds(token)
-    if not inbounds:
-        logger.error(f"Не удалось получить inbounds для user_id={user_id}")
-        return
+    try:
+        user_data = await get_vpn_user(token, username)
+    except MarzbanError as e:
+        # Без ответа Marzban нельзя ни отключить ключ, ни запланировать следующее действие
+        logger.warning(f"Marzban недоступен для user_id={user_id}, повторим позже: {e}")
+        return RETRY
+    last_active_dt = None
 
     if user_data:
         online_at = user_data.get("online_at")
         created_at = user_data.get("created_at")
         last_active = online_at or created_at
         if last_active:
-            last_active_dt = datetime.fromisoformat(last_active.replace("Z", "+00:00"))
+            last_active_dt = _parse_marzban_time(last_active)
             if (current_time - last_active_dt).days >= 15 and not status["active"]:
-                logger.info(f"Пользователь {username} неактивен более 15 дней, удаляем ключ")
-                await delete_vpn_user(token, username)
+                logger.info("Пользователь %s неактивен более 15 дней, удаляем ключ", username)
+                if not await delete_vpn_user(token, username):
+                    return RETRY
                 await save_vpn_key(user_id, None)
+                await record_marzban_states([(user_id, None)])
                 user_data = None
+                last_active_dt = None
 
-    if not user_data or not status["vpn_key"]:
-        vpn_key = await create_vpn_user(token, username, inbounds)
-        if not vpn_key or not vpn_key.get("subscription_url"):
-            logger.error(f"Не удалось создать пользователя {username} в Marzban")
+    # Ключ создаём только для активной подписки: истёкшим его выдаст proc_payment после оплаты
+    if status["active"] and (not user_data or not status["vpn_key"]):
+        vpn_key = await provision_vpn_key(user_id, token)
+        if not vpn_key:
+            return RETRY
+        user_data = vpn_key
+        last_active_dt = current_time
+
+    if user_data and not status["active"]:
+        # Статус взят при захвате строки; если пользователь успел оплатить, отключать ключ нельзя.
+        # Оплата сама поставила next_action_at = now, и пользователь придёт снова со свежим статусом
+        fresh = await get_user_status(user_id)
+        if fresh and fresh["active"]:
+            return RETRY
+
+    if user_data:
+        synced = await sync_marzban_status(token, user, username, "active" if status["active"] else "disabled",
+                                           user_data, current_time)
+        if not synced:
+            return RETRY
+
+    # Напоминание уходит через outbox: ключ (user, вид, subscription_end) не даст отправить его повторно
+    kind = reminder_kind(status["days_left"]) if status["active"] else None
+    if kind:
+        await enqueue_reminders([(user_id, kind, user["subscription_end"])])
+
+    return next_action_time(user["subscription_end"], current_time, last_active_dt)
+
+def _user_key(user):
+    return f"user_id={user['user_id']}"
+
+async def _claim_stream():
+    # Забираем только пользователей, чей next_action_at наступил; SKIP LOCKED позволяет
+    # нескольким процессам разбирать очередь без пересечений. Следующая пачка забирается,
+    # пока предыдущая ещё в работе, — пул не простаивает на границе пачек
+    while True:
+        now = datetime.now()
+        users = await claim_due_users(now, now + timedelta(minutes=SWEEP_LEASE_MINUTES), SWEEP_BATCH_SIZE)
+        for user in users:
+            yield user
+        if len(users) < SWEEP_BATCH_SIZE:
+            return
+
+async def process_due_users(token):
+    async def on_result(user, result):
+        # Пользователи с ошибкой остаются на аренде и вернутся в очередь через SWEEP_LEASE_MINUTES.
+        # Результат пишется сразу и только поверх нашей аренды, чтобы не затереть время, выставленное оплатой
+        if result is RETRY:
             return
-        await save_vpn_key(user_id, vpn_key["subscription_url"])
-        logger.info(f"Пользователь {username} успешно создан в Marzban")
+        try:
+            await set_next_action(user["user_id"], result, user["lease_until"])
+        except Exception as e:
+            logger.error(f"Не удалось записать следующее действие user_id={user['user_id']}: {e}")
 
-    if not status["active"]:
-        await disable_vpn_user(token, username)
-    elif status["active"]:
-        await enable_vpn_user(token, username)
+    return await run_pool(
+        "Очередь подписок", _claim_stream(), lambda user: process_user(user, token, status=user["status"]),
+        SWEEP_CONCURRENCY, SWEEP_USER_TIMEOUT, on_result=on_result, retry=RETRY, key=_user_key
+    )
 
-    if status["days_left"] == 3:
-        await bot.send_message(user_id, "⚠️ Ваша подписка истекает через 3 дня! Продлите доступ в меню 'Купить'.")
+async def process_all_users(token):
+    # Пользователи читаются постранично и сразу подаются в пул, без выгрузки всего списка
+    users = iter_users(datetime.now() + timedelta(days=7), datetime.now() - timedelta(days=1))
+    return await run_pool(
+        "Проверка подписок", users, lambda user: process_user(user, token),
+        SWEEP_CONCURRENCY, SWEEP_USER_TIMEOUT, retry=RETRY, key=_user_key
+    )
 
 async def check_subscriptions():
     logger.info("Запуск проверки подписок")
-    pool = await init_db_pool()
     token = await get_marzban_token()
     if not token:
         logger.error("Не удалось получить токен Marzban")
         return
 
-    async with pool.acquire() as conn:
-        users = await conn.fetch("""
-            SELECT user_id, subscription_end 
-            FROM users 
-            WHERE subscription_end IS NOT NULL 
-            AND (subscription_end < $1 OR subscription_end > $2)
-        """, datetime.now() + timedelta(days=7), datetime.now() - timedelta(days=1))
-
-    logger.info(f"Найдено пользователей для проверки: {len(users)}")
-    batch_size = 50
-    for i in range(0, len(users), batch_size):
-        batch = users[i:i + batch_size]
-        tasks = [process_user(user, token) for user in batch]
-        await asyncio.gather(*tasks)
+    started = time.perf_counter()
+    if SWEEP_MODE == "due":
+        users = (await process_due_users(token)).processed
+    elif SWEEP_MODE == "reconcile":
+        users = await reconcile_subscriptions(token)
+    else:
+        users = (await process_all_users(token)).processed
+    observe_sweep(SWEEP_MODE, started, users)
+
+async def reconcile_job():
+    # Периодическая полная сверка в режиме due: ловит расхождения, которых очередь не видит
+    token = await get_marzban_token()
+    if not token:
+        logger.error("Не удалось получить токен Marzban")
+        return
+    started = time.perf_counter()
+    users = await reconcile_subscriptions(token)
+    observe_sweep("reconcile", started, users)
+
+async def _due_loop():
+    while True:
+        try:
+            await check_subscriptions()
+        except Exception as e:
+            logger.error(f"Ошибка обработки очереди подписок: {e}")
+        # Спим до ближайшего next_action_at, но не дольше SWEEP_MAX_SLEEP
+        next_due = await get_next_due_at()
+        delay = SWEEP_MAX_SLEEP
+        if next_due is not None:
+            delay = min(max((next_due - datetime.now()).total_seconds(), 0), SWEEP_MAX_SLEEP)
+        await asyncio.sleep(delay)
+
+def start_due_loop():
+    global _due_task
+    if _due_task is None:
+        _due_task = asyncio.create_task(_due_loop())
+
+async def stop_due_loop():
+    global _due_task
+    if _due_task is not None:
+        _due_task.cancel()
+        await asyncio.gather(_due_task, return_exceptions=True)
+        _due_task = None
 
 async def setup_scheduler():
     logger.info("Настройка scheduler")
-    scheduler.add_job(check_subscriptions, "interval", minutes=20)
-    scheduler.start()
\ No newline at end of file
+    if SWEEP_MODE == "due":
+        scheduler.add_job(reconcile_job, "interval", minutes=RECONCILE_INTERVAL_MINUTES)
+    else:
+        scheduler.add_job(check_subscriptions, "interval", minutes=20)
+    scheduler.start()
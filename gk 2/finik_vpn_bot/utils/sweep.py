@@ -0,0 +1,95 @@
+from dataclasses import dataclass, field
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SweepStats:
+    name: str
+    processed: int = 0
+    ok: int = 0
+    retry: int = 0
+    failed: int = 0
+    timed_out: int = 0
+    durations: list = field(default_factory=list)
+    started_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started_at
+
+    def percentile(self, q):
+        if not self.durations:
+            return 0.0
+        ordered = sorted(self.durations)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def summary(self):
+        elapsed = self.elapsed
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        return (
+            f"{self.name}: обработано={self.processed}, успешно={self.ok}, повтор={self.retry}, "
+            f"ошибок={self.failed}, таймаутов={self.timed_out}, за {elapsed:.1f}с ({rate:.1f}/с), "
+            f"p50={self.percentile(0.5):.2f}с, p99={self.percentile(0.99):.2f}с, "
+            f"max={max(self.durations, default=0.0):.2f}с"
+        )
+
+
+async def run_pool(name, items, worker, concurrency, timeout, on_result=None, retry=None, key=repr,
+                   progress_every=1000):
+    # Потоковый пул: держит не больше concurrency задач в работе и берёт следующую, как только
+    # освободился слот. items — обычный или асинхронный итератор; ошибка или таймаут одного
+    # элемента не прерывает прогон, а передаётся в on_result как retry
+    stats = SweepStats(name)
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+
+    async def run_one(item):
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(worker(item), timeout)
+        except asyncio.TimeoutError:
+            stats.timed_out += 1
+            logger.warning(f"{name}: превышено время обработки {timeout}с для {key(item)}")
+            result = retry
+        except Exception as e:
+            stats.failed += 1
+            logger.error(f"{name}: ошибка обработки {key(item)}: {e}")
+            result = retry
+        else:
+            if retry is not None and result is retry:
+                stats.retry += 1
+            else:
+                stats.ok += 1
+        finally:
+            stats.durations.append(time.monotonic() - started)
+            stats.processed += 1
+            semaphore.release()
+        if progress_every and stats.processed % progress_every == 0:
+            logger.info("%s: обработано %s за %.1fс", name, stats.processed, stats.elapsed)
+        if on_result is not None:
+            await on_result(item, result)
+
+    async def submit(item):
+        await semaphore.acquire()
+        task = asyncio.create_task(run_one(item))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    try:
+        if hasattr(items, "__aiter__"):
+            async for item in items:
+                await submit(item)
+        else:
+            for item in items:
+                await submit(item)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        for task in tasks:
+            task.cancel()
+    logger.info(stats.summary())
+    return stats
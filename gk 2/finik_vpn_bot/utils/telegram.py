@@ -0,0 +1,17 @@
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from config import TELEGRAM_BOT_TOKEN, TELEGRAM_API_URL, TRACE_ENABLED
+from utils.tracing import TelegramSpanMiddleware
+from utils.runtime import json_loads, json_dumps
+
+
+def create_bot():
+    # Без TELEGRAM_API_URL бот ходит в api.telegram.org
+    kwargs = {"json_loads": json_loads, "json_dumps": json_dumps}
+    if TELEGRAM_API_URL:
+        kwargs["api"] = TelegramAPIServer.from_base(TELEGRAM_API_URL)
+    bot = Bot(token=TELEGRAM_BOT_TOKEN, session=AiohttpSession(**kwargs))
+    if TRACE_ENABLED:
+        bot.session.middleware(TelegramSpanMiddleware())
+    return bot
@@ -0,0 +1,207 @@
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from config import TRACE_SLOW_MS, TRACE_BUFFER_SIZE, TRACE_FILE, TRACE_FILE_MAX_BYTES
+import asyncio
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Трассировка апдейта: outer middleware открывает трассу, вызовы БД, Marzban, ЮKassa и Bot API
+# добавляют в неё дочерние спаны. Медленные трассы оседают в кольцевом буфере и в файле
+_current_trace = ContextVar("current_trace", default=None)
+_slow_traces = deque(maxlen=TRACE_BUFFER_SIZE)
+
+MAX_SPANS = 200
+# Записи в файл идут из пула потоков; ротация и дозапись не должны пересекаться
+_file_lock = threading.Lock()
+
+
+class Trace:
+    __slots__ = ("update_id", "user_id", "label", "started", "started_at", "spans", "dropped")
+
+    def __init__(self, update_id, user_id, label):
+        self.update_id = update_id
+        self.user_id = user_id
+        self.label = label
+        self.started = time.perf_counter()
+        self.started_at = datetime.now()
+        self.spans = []
+        self.dropped = 0
+
+    def add(self, name, started, duration, error=None):
+        if len(self.spans) >= MAX_SPANS:
+            self.dropped += 1
+            return
+        self.spans.append((name, started - self.started, duration, error))
+
+    def as_dict(self, total):
+        return {
+            "ts": self.started_at.isoformat(timespec="seconds"),
+            "update_id": self.update_id,
+            "user_id": self.user_id,
+            "label": self.label,
+            "total_ms": round(total * 1000, 1),
+            "spans": [
+                {"name": name, "start_ms": round(offset * 1000, 1), "ms": round(duration * 1000, 1), "error": error}
+                for name, offset, duration, error in self.spans
+            ],
+            "dropped_spans": self.dropped,
+        }
+
+
+def record_span(name, started, error=None):
+    # started — time.perf_counter() в начале вызова; без активной трассы ничего не делает
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, started, time.perf_counter() - started, error)
+
+
+@contextmanager
+def span(name):
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = type(e).__name__
+        raise
+    finally:
+        trace.add(name, started, time.perf_counter() - started, error)
+
+
+def on_query(record):
+    # Колбэк asyncpg add_query_logger: вызывается через call_soon в контексте запроса
+    trace = _current_trace.get()
+    if trace is None:
+        return
+    query = " ".join(record.query.split())[:60]
+    error = type(record.exception).__name__ if record.exception else None
+    trace.add(f"db {query}", time.perf_counter() - record.elapsed, record.elapsed, error)
+
+
+class TelegramSpanMiddleware:
+    # Middleware сессии aiogram: каждый вызов Bot API (send_message, delete_message...) — отдельный спан
+    async def __call__(self, make_request, bot, method):
+        with span(f"telegram {type(method).__name__}"):
+            return await make_request(bot, method)
+
+
+def _label(update: Update):
+    event = update.event
+    text = getattr(event, "text", None) or getattr(event, "data", None) or ""
+    return f"{update.event_type}:{text[:32]}"
+
+
+def _trace_file():
+    if not TRACE_FILE:
+        return None
+    # У каждого рабочего процесса свой файл трасс
+    worker_index = os.getenv("WORKER_INDEX")
+    if worker_index:
+        root, ext = os.path.splitext(TRACE_FILE)
+        return f"{root}.worker{worker_index}{ext}"
+    return TRACE_FILE
+
+
+def _append(path, line):
+    with _file_lock:
+        try:
+            if TRACE_FILE_MAX_BYTES and os.path.getsize(path) >= TRACE_FILE_MAX_BYTES:
+                os.replace(path, f"{path}.1")
+        except FileNotFoundError:
+            pass
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+def _store(entry):
+    _slow_traces.append(entry)
+    path = _trace_file()
+    if path:
+        # Запись в файл уходит в пул потоков, обработчик апдейта не ждёт диск
+        line = json.dumps(entry, ensure_ascii=False)
+        asyncio.get_running_loop().run_in_executor(None, _append, path, line)
+
+
+class TracingMiddleware(BaseMiddleware):
+    # Outer middleware на dp.update: одна трасса на апдейт, включая фильтры и все handler'ы
+    async def __call__(self, handler, event: Update, data):
+        user = data.get("event_from_user")
+        trace = Trace(event.update_id, user.id if user else None, _label(event))
+        token = _current_trace.set(trace)
+        try:
+            return await handler(event, data)
+        finally:
+            _current_trace.reset(token)
+            total = time.perf_counter() - trace.started
+            if total * 1000 >= TRACE_SLOW_MS:
+                _store(trace.as_dict(total))
+
+
+def _tail(path, limit, block_size=16384):
+    # Последние limit строк файла: читаем блоками с конца, не загружая файл целиком
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return []
+    with f:
+        position = f.seek(0, os.SEEK_END)
+        data = b""
+        while position > 0 and data.count(b"\n") <= limit:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+    lines = data.splitlines()
+    if position > 0:
+        # Первая строка блока может быть обрезана
+        lines = lines[1:]
+    return lines[-limit:]
+
+
+def _read_file_traces(limit):
+    if not TRACE_FILE:
+        return []
+    root, ext = os.path.splitext(TRACE_FILE)
+    entries = []
+    for path in glob.glob(TRACE_FILE) + glob.glob(f"{root}.worker*{ext}"):
+        lines = _tail(path, limit)
+        if len(lines) < limit:
+            lines = _tail(f"{path}.1", limit - len(lines)) + lines
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # Строка могла быть дописана не до конца
+                continue
+    entries.sort(key=lambda entry: entry["ts"])
+    return entries[-limit:]
+
+
+async def get_slow_traces(limit=10):
+    # Файл общий для всех процессов, поэтому читаем его; без файла — буфер этого процесса
+    if TRACE_FILE:
+        return await asyncio.to_thread(_read_file_traces, limit)
+    return list(_slow_traces)[-limit:]
+
+
+def format_trace(entry, max_spans=15):
+    lines = [f"{entry['ts']} {entry['label']} — {entry['total_ms']} мс (user_id={entry['user_id']})"]
+    spans = sorted(entry["spans"], key=lambda s: s["ms"], reverse=True)[:max_spans]
+    for s in sorted(spans, key=lambda s: s["start_ms"]):
+        error = f" ❌{s['error']}" if s["error"] else ""
+        lines.append(f"  +{s['start_ms']:.0f} {s['ms']:.0f} мс {s['name']}{error}")
+    return "\n".join(lines)
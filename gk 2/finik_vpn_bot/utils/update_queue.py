@@ -0,0 +1,71 @@
+from aiogram.types import Update
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def update_key(update: Update):
+    # Апдейты одного пользователя попадают в один шард и обрабатываются строго по порядку
+    try:
+        event = update.event
+    except Exception:
+        # Незнакомый aiogram тип апдейта (например, из новой версии Bot API)
+        return update.update_id
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return user.id
+    chat = getattr(event, "chat", None)
+    if chat is not None:
+        return chat.id
+    return update.update_id
+
+
+class UpdateQueue:
+    # Ограниченная очередь апдейтов: по воркеру и собственной очереди на шард,
+    # шард выбирается по user_id
+    def __init__(self, handler, workers=16, maxsize=1000, put_timeout=2.0):
+        self._handler = handler
+        self._put_timeout = put_timeout
+        shard_size = max(1, maxsize // workers)
+        self._shards = [asyncio.Queue(maxsize=shard_size) for _ in range(workers)]
+        self._tasks = []
+
+    def qsize(self):
+        return sum(shard.qsize() for shard in self._shards)
+
+    async def submit(self, update: Update):
+        # False — очередь переполнена; вебхук ответит ошибкой, и Telegram повторит доставку позже
+        shard = self._shards[update_key(update) % len(self._shards)]
+        try:
+            await asyncio.wait_for(shard.put(update), timeout=self._put_timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning(f"Очередь апдейтов переполнена, update_id={update.update_id} отклонён")
+            return False
+
+    async def _worker(self, shard):
+        while True:
+            update = await shard.get()
+            try:
+                await self._handler(update)
+            except Exception as e:
+                logger.error(f"Ошибка обработки update_id={update.update_id}: {e}")
+            finally:
+                shard.task_done()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(shard)) for shard in self._shards]
+
+    async def stop(self, drain_timeout=10.0):
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(shard.join() for shard in self._shards)), timeout=drain_timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Не дождались обработки {self.qsize()} апдейтов при остановке")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,96 @@
+import aiohttp
+import asyncio
+import base64
+import logging
+import time
+from config import YUKASSA_SHOP_ID, YUKASSA_SECRET_KEY, YUKASSA_TIMEOUT, YUKASSA_MAX_RETRIES, YUKASSA_API_URL
+from utils.metrics import observe_external
+from utils.tracing import record_span
+from utils.runtime import json_loads, json_dumps
+
+logger = logging.getLogger(__name__)
+
+class YooKassaClient:
+    # Асинхронный клиент ЮKassa с общим пулом соединений; не блокирует event loop
+    def __init__(self, shop_id, secret_key, base_url=YUKASSA_API_URL, timeout=10.0, max_retries=3):
+        self._base_url = base_url.rstrip("/")
+        credentials = base64.b64encode(f"{shop_id}:{secret_key}".encode()).decode()
+        self._auth_header = f"Basic {credentials}"
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._max_retries = max_retries
+        self._session = None
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=20, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self._timeout,
+                headers={"Authorization": self._auth_header},
+                json_serialize=json_dumps
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _post(self, path, payload, idempotence_key):
+        # Повторы идут с тем же Idempotence-Key, поэтому ЮKassa не создаст второй платёж
+        headers = {"Idempotence-Key": idempotence_key}
+        for attempt in range(self._max_retries + 1):
+            delay = 0.5 * 2 ** attempt
+            endpoint = f"POST {path}"
+            started = time.perf_counter()
+            try:
+                async with self._get_session().post(
+                    f"{self._base_url}{path}", json=payload, headers=headers
+                ) as response:
+                    if response.status == 200:
+                        data = await response.json(loads=json_loads)
+                        observe_external("yookassa", endpoint, started)
+                        record_span(f"yookassa {endpoint}", started)
+                        return data
+                    text = await response.text()
+                    observe_external("yookassa", endpoint, started, str(response.status))
+                    record_span(f"yookassa {endpoint}", started, str(response.status))
+                    if response.status == 202 or response.status == 429 or response.status >= 500:
+                        # 202 — запрос ещё обрабатывается, ЮKassa просит повторить его позже
+                        logger.warning(f"ЮKassa ответила {response.status}, попытка {attempt + 1}: {text}")
+                    else:
+                        logger.error(f"Ошибка запроса к ЮKassa {path}: {response.status} - {text}")
+                        return None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                observe_external("yookassa", endpoint, started, "network")
+                record_span(f"yookassa {endpoint}", started, "network")
+                logger.warning(f"Сетевая ошибка ЮKassa {path}, попытка {attempt + 1}: {e!r}")
+            if attempt < self._max_retries:
+                await asyncio.sleep(delay)
+        logger.error(f"ЮKassa не ответила на {path} после {self._max_retries + 1} попыток")
+        return None
+
+    async def create_payment(self, payload, idempotence_key):
+        return await self._post("/payments", payload, idempotence_key)
+
+
+_client = None
+
+
+def get_yookassa_client():
+    global _client
+    if _client is None:
+        _client = YooKassaClient(
+            YUKASSA_SHOP_ID,
+            YUKASSA_SECRET_KEY,
+            timeout=YUKASSA_TIMEOUT,
+            max_retries=YUKASSA_MAX_RETRIES
+        )
+    return _client
+
+
+async def close_yookassa_client():
+    global _client
+    if _client is not None:
+        await _client.close()
+        _client = None